@@ -12,9 +12,32 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
 import utils as u
+import interval_index as ii
+import transcripts as tx
+import dbsnp_index
+import bgzf
+import vcf_record as vr
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Island names as written to INFO (whitespace removed), per island row
+_islandNames = {}
+
+"""Name of the first cpgIslandExt island containing pos, or None
+   Islands are looked up in a per-chromosome interval index
+"""
+def getCpgIslandName(cursor, chrom, pos):
+    island = ii.getIndex(cursor, 'cpgIslandExt', chrom=chrom,
+        columns='chrom, chromStart, chromEnd, name').first(int(pos))
+    if (island is None):
+        return None
+
+    name = _islandNames.get(island)
+    if (name is None):
+        name = "".join(str(island[3]).split())
+        _islandNames[island] = name
+    return name
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -107,89 +130,312 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
+"""Base class for the annotation stages
+   annotate() mutates one data line, a vcf_record.VcfRecord, in place, the
+   pipeline in driver.py runs every stage over each parsed chunk of
+   records and summary() returns the stage's lines for the .count.log
+"""
+class AnnotationStage(object):
+    name = ''
+    logmode = 'a'
+
+    def __init__(self, format='vcf', table=None):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.table = table
+        self.conn = None
+        self.cursor = None
+        # Counters behind summary(); shards of a job are merged by addition
+        self.counts = {'var_count': 0, 'line_count': 0}
+        # While a list, receives a copy of the counters after each record
+        self.tally = None
+
+    """conn, if given, is shared with other stages and left open by close()
+    """
+    def open(self, conn=None):
+        self.shared = (conn is not None)
+        self.conn = conn if self.shared else u.db_connect()
+        self.cursor = self.conn.cursor()
+
+    def close(self):
+        if (self.conn is not None) and not self.shared:
+            self.conn.close()
+        self.conn = None
+        self.cursor = None
+
+    """Lines passed through unchanged by this stage
+    """
+    def isHeader(self, line):
+        return (line.startswith('##') or line.startswith('#CHROM') or
+            line.startswith('CHROM'))
+
+    def annotateChunk(self, chunk):
+        for record in chunk:
+            self.annotate(record)
+            self.mark()
+
+    """Records the counters after a record of annotateChunk(), so that the
+       changes of each record can be told apart (see driver.annotateTraced)
+    """
+    def mark(self):
+        if (self.tally is not None):
+            self.tally.append(dict(self.counts))
+
+    def annotate(self, record):
+        raise NotImplementedError
+
+    def summary(self):
+        return [f"In {str(self.table)}: {str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants"]
+
+
+"""Stage answering 'chromStart <= pos AND pos <= chromEnd' lookups from an
+   interval index; annotateChunk() looks up all positions of a chromosome
+   in one vectorized call
+   With sweep=True the table is instead streamed per chromosome and merged
+   with the variants (ii.SweepJoin), which keeps memory flat on large
+   tables but expects position-sorted input; hits then come in start
+   order rather than table order. Stages using only the first hit
+   (first = True) always use the index, so that they pick the same row
+   in both modes
+"""
+class RangeStage(AnnotationStage):
+    # Only the first overlapping row is used, as with fetchone()
+    first = False
+
+    def __init__(self, format='vcf', table=None, sweep=False):
+        AnnotationStage.__init__(self, format=format, table=table)
+        self.sweep = sweep and not self.first
+        self.join = None
+
+    def close(self):
+        if (self.join is not None):
+            self.join[1].close()
+        self.join = None
+        AnnotationStage.close(self)
+
+    """Chromosome name as stored in the table, None to skip the record
+    """
+    def chrom(self, record):
+        chr = record.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    """Table and ii.getIndex() arguments holding the rows of chrom
+    """
+    def source(self, chrom):
+        return self.table, {'chrom': chrom}
+
+    def index(self, chrom):
+        table, args = self.source(chrom)
+        if not self.sweep:
+            return ii.getIndex(self.cursor, table, **args)
+
+        # One stream open at a time; sorted input visits each chromosome once
+        if (self.join is None) or (self.join[0] != chrom):
+            if (self.join is not None):
+                self.join[1].close()
+            self.join = (chrom, ii.SweepJoin(table, **args))
+        return self.join[1]
+
+    """rows: overlapping rows in table order (at most one if self.first)
+    """
+    def addRows(self, record, rows):
+        raise NotImplementedError
+
+    def annotate(self, record):
+        chrom = self.chrom(record)
+        rows = []
+        if (chrom is not None):
+            index = self.index(chrom)
+            pos = int(record.pos)
+            if self.first:
+                row = index.first(pos)
+                if (row is not None):
+                    rows = [row]
+            else:
+                rows = index.query(pos)
+        self.addRows(record, rows)
+
+    def annotateChunk(self, chunk):
+        members = {}
+        for i in range(len(chunk)):
+            chrom = self.chrom(chunk[i])
+            if (chrom is not None):
+                members.setdefault(chrom, []).append(i)
+
+        hits = [[] for record in chunk]
+        for chrom in members:
+            index = self.index(chrom)
+            positions = [int(chunk[i].pos) for i in members[chrom]]
+            variants, rows = index.queryMany(positions, first=self.first)
+            for v, r in zip(variants, rows):
+                hits[members[chrom][v]].append(r)
+
+        for i in range(len(chunk)):
+            self.addRows(chunk[i], hits[i])
+            self.mark()
+
+
+"""Runs a single stage over a whole file
+"""
+def annotateFile(stage, infile, outfile, logfile, sep='\t'):
+    fh = bgzf.openText(infile)
     fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    stage.open()
 
     for line in fh:
         line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+        if stage.isHeader(line):
+            fh_out.write(line + '\n')
+        else:
+            record = vr.VcfRecord(line.split(sep), stage.inds)
+            stage.annotate(record)
+            fh_out.write(record.line() + '\n')
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+    stage.close()
+    fh.close()
+    fh_out.close()
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+    lines = stage.summary()
+    if (len(lines) > 0):
+        fh_log = open(logfile, stage.logmode)
+        for l in lines:
+            fh_log.write(l + '\n')
+        fh_log.close()
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+class DbSnpStage(AnnotationStage):
+    name = 'dbSNP'
+    logmode = 'w'
+
+    """batchsize > 0 resolves each chunk with one 'POS IN (...)' query per
+       chromosome and batchsize positions, matching REF client-side;
+       index_dir, a directory built by dbsnp_index.py, replaces the
+       database lookups altogether
+    """
+    def __init__(self, format='vcf', varclass='SNV', batchsize=0,
+        index_dir=None):
+        AnnotationStage.__init__(self, format=format, table='dbSNP')
+        self.varclass = varclass
+        self.batchsize = batchsize
+        self.index = None
+        if (index_dir is not None):
+            self.index = dbsnp_index.getIndex(index_dir)
+        self.counts = {'var_count': 0, 'lines': 0}
+
+    def open(self, conn=None):
+        if (self.index is None):
+            AnnotationStage.open(self, conn)
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def parse(self, record):
+        chr = record.chrom
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+
+        ref = clean_mysql_chars(record.ref).strip()
+        return [chr, record.pos, ref, getComplementary(ref)]
+
+    def annotate(self, record):
+        chr, pos, ref, compRef = self.parse(record)
+
+        if (self.index is not None):
+            refs = [ref.upper(), compRef.upper()]
+            self.addSnps(record, [(r[1], r[2]) for r in
+                self.index.lookup(chr, int(pos)) if (r[0].upper() in refs) and
+                (r[3].upper() == self.varclass.upper())])
+            return
+
+        sql = 'select * from dbSNP where CHR="' + str(chr) + \
+            '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+            '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+            self.varclass + '" ;'
+        self.cursor.execute(sql)
+        self.addSnps(record, [(row[3], row[7]) for row in
+            self.cursor.fetchall()])
+
+    def annotateChunk(self, chunk):
+        if (not self.batchsize) or (self.index is not None):
+            AnnotationStage.annotateChunk(self, chunk)
+            return
+
+        parsed = [self.parse(record) for record in chunk]
+        positions = {}
+        for p in parsed:
+            positions.setdefault(p[0], set()).add(int(p[1]))
+
+        # (chr, pos) -> [(REF, row), ...] in database order
+        found = {}
+        for chr in positions:
+            plist = sorted(positions[chr])
+            for i in range(0, len(plist), self.batchsize):
+                sql = 'select REF, POS, dbSNP.* from dbSNP where CHR="' + \
+                    str(chr) + '" AND POS IN (' + \
+                    ','.join([str(x) for x in plist[i:i + self.batchsize]]) + \
+                    ') AND INFO = "' + self.varclass + '" ;'
+                self.cursor.execute(sql)
+                for row in self.cursor.fetchall():
+                    found.setdefault((chr, int(row[1])), []).append(
+                        (str(row[0]).upper(), (row[2 + 3], row[2 + 7])))
+
+        for record, p in zip(chunk, parsed):
+            chr, pos, ref, compRef = p
+            refs = [ref.upper(), compRef.upper()]
+            snps = [snp for (r, snp) in found.get((chr, int(pos)), [])
+                if r in refs]
+            self.addSnps(record, snps)
+            self.mark()
+
+    """snps: [(rsID, GMAF), ...] of the matching dbSNP records
+    """
+    def addSnps(self, record, snps):
+        varclass = self.varclass
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        record[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(snps) > 0):
+            for (rsid, gmaf) in snps:
+                rsids.append(str(rsid))
+                if (str(gmaf) != '.'):
+                    mafs.append('GMAF=' + str(gmaf))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join(mafs)
+
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            if (record.getInfo() == '.'):
+                record.setInfo('DB' + maf_str)
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                record.addInfo(';DB;VC=' + varclass + maf_str)
 
-            linenum = linenum + 1
+            record[2] = ';'.join(rsids)
 
-        else:
-            fh_out.write(line + '\n')
+        self.counts['lines'] = self.counts['lines'] + 1
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def summary(self):
+        linenum = self.counts['lines'] + 1
+        var_count = self.counts['var_count']
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        return ["## Please notice that all Isoforms were counted",
+            "## Numbers may exceed number of variants in the annotated file",
+            f"Total: {str(linenum)}",
+            f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)"]
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
+
+    annotateFile(DbSnpStage(format=format, varclass=varclass), vcf,
+        vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,308 +443,195 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
+class BigRefGeneStage(AnnotationStage):
+    name = 'BigRefGene'
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def annotate(self, record):
+        chr = record.chrom
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+
+        pos = record.pos
+        ref = clean_mysql_chars(record.ref).strip()
+        alt = clean_mysql_chars(record.alt).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        # The three tables share a schema: probe them in one query and use
+        # the rows of the lowest tier that has any, i.e. the first table
+        # that a query per table would have found
+        sql = 'select 1, chrom_pos_equal_base.* from chrom_pos_equal_base ' + \
+            'where CHR="' + str(chr) + '" AND start = ' + str(pos) + \
+            ' AND ((haplotypeReference="' + str(ref) + \
+            '" AND haplotypeAlternate ="' + str(alt) + \
+            '") OR (haplotypeReference="' + str(compRef) + \
+            '" AND haplotypeAlternate ="' + str(compAlt) + '"))' + \
+            ' union all ' + \
+            'select 2, chrom_pos_equal_nobase.* from chrom_pos_equal_nobase ' + \
+            'where CHR="' + str(chr) + '" AND start = ' + str(pos) + \
+            ' union all ' + \
+            'select 3, chrom_pos_unequal.* from chrom_pos_unequal ' + \
+            'where CHR="' + str(chr) + '" AND start <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= end ;'
+
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+
+        if (len(rows) > 0):
+            tier = min([int(row[0]) for row in rows])
+            m = set([])
+            for row in rows:
+                if (int(row[0]) == tier):
+                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[2:len(row)]])))
+
+            info = record.getInfo() + ';' + ';'.join(m)
+            if info.startswith(".;"):
+                info = info.replace('.;', '', 1)
+            record.setInfo(info)
+
+    def summary(self):
+        return []
 
-            vcf_linenum = vcf_linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    annotateFile(BigRefGeneStage(format=format), vcf + tmpextin,
+        vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Get information about location in gene structures
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+class GenesStage(RangeStage):
+    name = 'Genes'
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        RangeStage.__init__(self, format=format, table=table)
+        self.promoter_offset = promoter_offset
+        self.counts = {'interGenic_count': 0, 'cds_count': 0,
+            'utr3_count': 0, 'utr5_count': 0, 'intronic_count': 0,
+            'non_coding_intronic_count': 0, 'exonic_count': 0,
+            'non_coding_exonic_count': 0, 'promoter_count': 0}
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    """Transcripts whose promoter-extended span contains the position
+    """
+    def index(self, chrom):
+        return tx.getIndex(self.cursor, self.table, chrom,
+            promoter_offset=self.promoter_offset)
+
+    def addRows(self, record, transcripts):
+        promoter_offset = self.promoter_offset
+        counts = self.counts
+        cursor = self.cursor
+        chr = self.chrom(record)
+
+        pos = int(record.pos)
+        info = []
+
+        if (len(transcripts) > 0):
+            #count location
+            info_field = clean_mysql_chars(record.getInfo()).strip()
+            positionType = str(u.parse_field(info_field,
+                'positionType', ';', '='))
+
+            cnt = 1
+            for t in transcripts:
+                if (positionType == 'intron'):
+                    counts['intronic_count'] = counts['intronic_count'] + 1
+                elif (positionType == 'non_coding_intron'):
+                    counts['non_coding_intronic_count'] = \
+                        counts['non_coding_intronic_count'] + 1
+                elif (positionType == 'CDS'):
+                    counts['cds_count'] = counts['cds_count'] + 1
+                elif (positionType == 'non_coding_exon'):
+                    counts['non_coding_exonic_count'] = \
+                        counts['non_coding_exonic_count'] + 1
+                elif (positionType == 'utr5'):
+                    counts['utr5_count'] = counts['utr5_count'] + 1
+                elif (positionType == 'utr3'):
+                    counts['utr3_count'] = counts['utr3_count'] + 1
+
+                exonCount = t.exonCount
+                strand = t.strand
+                promoter_plus = t.txStart - int(promoter_offset)
+                promoter_minus = t.txEnd + int(promoter_offset)
+                region = ""
+                exons = []
+
+                if (t.cdsStart == t.cdsEnd):
+                    for e in t.exons(pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum = exonCount - e
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, t.cdsStart, t.cdsEnd)):
+                    for e in t.exons(pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum = exonCount - e
+                        exons.append("exon=" +  "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        counts['exonic_count'] = counts['exonic_count'] + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (u.isBetween(pos, promoter_plus, t.txStart) and
+                    (strand == "+")):
+                    island = getCpgIslandName(cursor, chr, pos)
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + island
+                        counts['promoter_count'] = counts['promoter_count'] + 1
+
+                elif (u.isBetween(pos, t.txEnd, promoter_minus) and
+                    (strand == "-")):
+                    island = getCpgIslandName(cursor, chr, pos)
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + island
+                        counts['promoter_count'] = counts['promoter_count'] + 1
+
+                if (region != ''):
+                    info.append(collapseGeneNames(row=t.row,
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            record.addInfo(';' + ";".join(info))
 
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+            record.addInfo(";positionType=interGenic")
+            counts['interGenic_count'] = counts['interGenic_count'] + 1
+
+    def summary(self):
+        counts = self.counts
+        lines = ["Variants located:",
+            f"In interGenic {str(counts['interGenic_count'])}",
+            f"In CDS {str(counts['cds_count'])}",
+            f"In \'3 UTR {str(counts['utr3_count'])}",
+            f"In \'5 UTR {str(counts['utr5_count'])}",
+            f"In Intronic {str(counts['intronic_count'])}",
+            f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}",
+            f"In Exonic {str(counts['exonic_count'])}",
+            f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}",
+            f"In Putative Promoter Region {str(counts['promoter_count'])}"]
+        for l in lines:
+            print(l)
+        return lines
+
+
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    annotateFile(GenesStage(format=format, table=table,
+        promoter_offset=promoter_offset), vcf + tmpextin, vcf + tmpextout,
+        vcf + '.count.log', sep=sep)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -533,16 +666,16 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     for line in fh:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+            record = vr.VcfRecord(line.split(sep), inds)
+            chr = record.chrom
             
             if not chr.startswith("chr"):
                 chr = "chr" + chr
             
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+            pos = record.pos
+            ref = clean_mysql_chars(record.ref).strip()
+            alt = clean_mysql_chars(record.alt).strip()
+            info_field = clean_mysql_chars(record.getInfo()).strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
@@ -626,30 +759,16 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
+                        island = getCpgIslandName(cursor, chr, pos)
+                        if (island is not None):
+                            region = 'putativePromoterRegion=' + island
                             promoter_count = promoter_count + 1
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
+                        island = getCpgIslandName(cursor, chr, pos)
+                        if (island is not None):
+                            region = 'putativePromoterRegion=' + island
                             promoter_count = promoter_count + 1
 
                     else:
@@ -662,13 +781,12 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                record.addInfo(';' + ";".join(info))
+                fh_out.write(record.line() + '\n')
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                record.addInfo(";positionType=interGenic")
+                fh_out.write(record.line() + '\n')
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
@@ -714,690 +832,352 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class TfbsConsSitesStage(RangeStage):
+    name = 'tfbsConsSites'
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    def __init__(self, format='vcf', table='tfbsConsSites', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def chrom(self, record):
+        chr = record.chrom
+        # For some reason this table has no "chr" preceeding number
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        chrIndex=chr.replace('chr', '')
+        if (chrIndex in self.allowed_chrom):
+            return chrIndex
+        return None
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    def source(self, chrom):
+        return 'tfbsConsSites' + chrom, {'chromCol': None,
+            'columns': 'chrom, chromStart, chromEnd, name'}
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    def addRows(self, record, rows):
+        records = []
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            records_count = 1
+            self.counts['line_count'] = self.counts['line_count'] + 1
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
+                records_count = records_count + 1
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+            record.addInfoEntry(';'.join(records))
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(TfbsConsSitesStage(format=format, table=table),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+class GadAllStage(RangeStage):
+    name = 'gadAll'
+
+    def __init__(self, format='vcf', table='gadAll', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
+
+    def chrom(self, record):
+        chr = record.chrom
+        # For some reason this table has no "chr" preceeding number
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+        return chr
+
+    def source(self, chrom):
+        return self.table, {'chrom': chrom, 'chromCol': 'chromosome'}
+
+    def addRows(self, record, rows):
+        records = []
+
+        if (len(rows) > 0):
+            records_count = 1
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            r_tmp = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
+                    records_count = records_count + 1
+            record.addInfoEntry(';'.join(records))
+            # Annotated lines have always been written joined by '\t '
+            record.pad()
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    annotateFile(GadAllStage(format=format, table=table), vcf + tmpextin,
+        vcf + tmpextout, vcf + '.count.log', sep=sep)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(AnnotationStage):
+    name = 'GwasCatalog'
+
+    def __init__(self, format='vcf', table='gwasCatalog'):
+        AnnotationStage.__init__(self, format=format, table=table)
+
+    def annotate(self, record):
+        table = self.table
+        chr = record.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = record.pos
+        isOverlap = False
+
+        sql = 'select * from ' + table + ' where chrom="' + \
+            str(chr) + '" AND chromEnd = ' + str(pos) + ';'
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+        records = []
+
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            records_count = 1
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                records.append(str(table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+                records_count = records_count + 1
+            record.addInfoEntry(';'.join(records))
 
 
-""" Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(GwasCatalogStage(format=format, table=table),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HUGOGeneNomenclatureStage(RangeStage):
+    name = 'HUGO Gene Nomenclature Committee'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='hugo', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def addRows(self, record, rows):
+        records = []
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            records_count = 1
+            r_tmp = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
+                records_count = records_count + 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            records_str = ','.join(records).replace(';', ',')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            record.addInfoEntry(records_str)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t'):
+
+    annotateFile(HUGOGeneNomenclatureStage(format=format, table=table),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+class GenomicSuperDupsStage(RangeStage):
+    name = 'genomicSuperDups'
+    first = True
+
+    def __init__(self, format='vcf', table='genomicSuperDups', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
+
+    def addRows(self, record, rows):
+        isOverlap = False
+        otherChrom = ''
+        otherStart = ''
+        otherEnd = ''
+
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            isOverlap = True
+            otherChrom = rows[0][7]
+            otherStart = rows[0][8]
+            otherEnd = rows[0][9]
+            record.addInfo(';' + self.table + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
+    annotateFile(GenomicSuperDupsStage(format=format, table=table),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+class RefGeneStage(AnnotationStage):
+    name = 'RefGene'
+
+    def __init__(self, format='vcf', table='refGene'):
+        AnnotationStage.__init__(self, format=format, table=table)
+
+    def annotate(self, record):
+        table = self.table
+        colindex = 1
+        colindex2 = 12
+        name = 'name'
+        name2 = 'name2'
+        startName = 'txStart'
+        endName = 'txEnd'
+
+        chr = record.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = record.pos
+        isOverlap = False
+
+        sql = 'select * from ' + table + ' where chrom="' + \
+            str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= ' + endName +');'
+        overlapsWith = []
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                overlapsWith.append(name2 + '=' + \
+                    str(row[colindex2]) + ';' + name + '=' + \
+                    str(row[colindex]))
+
+            record.addInfoEntry(';'.join(overlapsWith))
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(RefGeneStage(format=format, table=table), vcf + tmpextin,
+        vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+class CytobandStage(RangeStage):
+    name = 'Cytoband'
+
+    def __init__(self, format='vcf', table='cytoBand', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def source(self, chrom):
+        return self.table, {'chrom': chrom, 'startCol': self.startName,
+            'endCol': self.endName}
+
+    def addRows(self, record, rows):
+        table = self.table
+        overlapsWith = []
+
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            record.addInfoEntry(table + '=' + ';'.join(overlapsWith))
+
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(CytobandStage(format=format, table=table), vcf + tmpextin,
+        vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabaseStage(RangeStage):
+    first = True
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='dgv_Cnv', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
+        self.name = table
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def addRows(self, record, rows):
+        table = self.table
+        isOverlap = False
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            isOverlap = True
+            record.addInfoEntry(table + '=' + str(isOverlap))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(CnvDatabaseStage(format=format, table=table),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(RangeStage):
+    name = 'miRNA'
+    first = True
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='targetScanS', sweep=False):
+        RangeStage.__init__(self, format=format, table=table, sweep=sweep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            t = str(rows[0][4]) + ',' +  str(rows[0][1]) + '_' + \
+                str(rows[0][2]) + '_' + str(rows[0][3])
+            t = 'miRNAsites=' + t.strip()
+            record.addInfoEntry(t)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def summary(self):
+        return [f"In miRNAsites: {str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants"]
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(MiRNAStage(format=format, table=table), vcf + tmpextin,
+        vcf + tmpextout, vcf + '.count.log', sep=sep)
 
-### EOF
\ No newline at end of file
+### EOF
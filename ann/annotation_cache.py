@@ -0,0 +1,121 @@
+# annotation_cache.py
+#
+# Persistent cache of annotated records, shared by the jobs run on an
+# annotator instance. Entries live in a SQLite file, keyed by the reference
+# version and the incoming variant (CHROM, POS, REF, ALT, ID, INFO), and
+# hold the annotated ID and INFO with each stage's counter changes, so that
+# a cached record leaves the output and the count log as they would be.
+# The least recently used entries are evicted once the entries add up to
+# more than max_bytes; SQLite reuses the pages they free, so the file
+# stays near that size.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import sqlite3
+
+# Keys looked up / stored per statement
+BATCH_SIZE = 500
+
+# Size of an entry, in bytes of its key and value
+ENTRY_SIZE = 'length(cast(key as blob)) + length(cast(value as blob))'
+
+
+class AnnotationCache(object):
+    def __init__(self, path, version, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.lookups = 0
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('pragma journal_mode=WAL')
+        self.db.execute('create table if not exists records ' + \
+            '(key text primary key, value text, used real);')
+        self.db.execute('create index if not exists records_used ' + \
+            'on records (used);')
+        self.db.commit()
+
+    """record: a vcf_record.VcfRecord, as are the records below
+    """
+    def key(self, record):
+        return '\t'.join([self.version, record[0], record[1], record[3],
+            record[4], record[2], record[7]])
+
+    """Cached entries of keys, {key: entry}; marks them as used
+    """
+    def getMany(self, keys):
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i + BATCH_SIZE]
+            rows = self.db.execute('select key, value from records ' + \
+                'where key in (' + ','.join(['?'] * len(batch)) + ');', batch)
+            for key, value in rows:
+                found[key] = json.loads(value)
+
+        if (len(found) > 0):
+            now = time.time()
+            self.db.executemany('update records set used = ? where key = ?;',
+                [(now, key) for key in found])
+            self.db.commit()
+        return found
+
+    """entries: {key: entry}
+    """
+    def putMany(self, entries):
+        now = time.time()
+        self.db.executemany('insert or replace into records ' + \
+            '(key, value, used) values (?, ?, ?);',
+            [(key, json.dumps(entries[key]), now) for key in entries])
+        self.db.commit()
+
+    """Annotates record from a cached entry
+    """
+    def apply(self, record, entry):
+        if entry['pad']:
+            record.pad()
+        record[2] = entry['id']
+        record[7] = entry['info']
+
+    """Entry for a record annotated from original into record, None if the
+       annotation changed more than ID, INFO and the gadAll padding
+       counts: each stage's counter changes for this record
+    """
+    def entry(self, original, record, counts):
+        for pad in [False, True]:
+            entry = {'id': record[2], 'info': record[7], 'pad': pad,
+                'counts': counts}
+            rebuilt = original.copy()
+            self.apply(rebuilt, entry)
+            if (rebuilt.columns() == record.columns()):
+                return entry
+        return None
+
+    def summary(self):
+        ratio = 0.0
+        if (self.lookups > 0):
+            ratio = (self.hits / float(self.lookups)) * 100
+        return [f"Annotation cache: {str(self.hits)} hits in " + \
+            f"{str(self.lookups)} variants ({str(ratio)}%)"]
+
+    """Evicts the least recently used entries past max_bytes, unless
+       evict is False (e.g. in the workers of a sharded job)
+    """
+    def close(self, evict=True):
+        size = 0
+        if evict:
+            size = self.db.execute('select coalesce(sum(' + ENTRY_SIZE + \
+                '), 0) from records;').fetchone()[0]
+        if (size > self.max_bytes):
+            # Keeps the most recently used entries that fit in max_bytes
+            self.db.execute('delete from records where key in ' + \
+                '(select key from (select key, sum(' + ENTRY_SIZE + \
+                ') over (order by used desc, key) as kept from records) ' + \
+                'where kept > ?);', (self.max_bytes,))
+            self.db.commit()
+        self.db.close()
+
+### EOF
@@ -2,13 +2,458 @@ from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
 from subprocess import Popen, PIPE, DEVNULL
 from configparser import SafeConfigParser
+from queue import Empty
+import multiprocessing
+import collections
+import atexit
 import subprocess
 import logging 
+import shutil
 import boto3
 import json
+import time
 import sys
 import os
 
+
+"""Free memory in MB as the kernel estimates it, None where unknown
+"""
+def availableMemory():
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+"""Resident memory of this process in MB, None where unknown
+"""
+def residentMemory():
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+"""Loop of a pool worker: runs the jobs sent to it on tasks until it is
+   sent None, has run max_jobs, or has grown max_growth MB past its size
+   after the first job. Reports (pid, job_id, code, retiring) when done
+   with a job, retiring being True if it exits after it
+"""
+def work(tasks, results, max_jobs, max_growth):
+    import run
+    base = None
+    done = 0
+    while True:
+        task = tasks.get()
+        if (task is None):
+            break
+        job_id, input_file, key, profile = task
+        code = 0
+        try:
+            with run.Timer():
+                run.runJob(input_file, key, profile)
+        except Exception as e:
+            logging.exception(e)
+            print (f"Job {job_id} failed: {e}")
+            code = 1
+        sys.stdout.flush()
+        done = done + 1
+
+        # Growth is measured from the first job on, once the imports,
+        # clients and reference indexes are all loaded
+        memory = residentMemory()
+        if (base is None):
+            base = memory
+        retiring = (done >= max_jobs) or ((memory is not None) and
+            (memory - base > max_growth))
+        results.put((os.getpid(), job_id, code, retiring))
+        if retiring:
+            break
+
+
+"""Long-lived worker processes that run jobs in process (run.runJob),
+   keeping the imports, config, AWS clients, database connections and
+   reference indexes warm from one job to the next. A worker is replaced
+   after jobs_per_worker jobs, or when it has grown max_growth MB
+   Each worker has its own task queue, so the job it holds is known from
+   the time it is submitted, and is failed if the worker dies
+"""
+class WorkerPool(object):
+    def __init__(self, size, jobs_per_worker, max_growth):
+        self.size = size
+        self.jobs_per_worker = jobs_per_worker
+        self.max_growth = max_growth
+        self.results = multiprocessing.Queue()
+        # (process, task queue) of the workers taking jobs, by pid
+        self.workers = {}
+        # Processes of the workers exiting after their last job
+        self.retiring = {}
+        # Job each worker is running, by pid
+        self.running = {}
+        # Jobs finished and not yet returned by reap()
+        self.finished = {}
+
+        # Imported before the workers are forked, so they start warm
+        import run
+        self.start()
+        atexit.register(self.close)
+
+    def start(self):
+        while (len(self.workers) < self.size):
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=work,
+                args=(tasks, self.results, self.jobs_per_worker,
+                    self.max_growth))
+            worker.start()
+            self.workers[worker.pid] = (worker, tasks)
+
+    def drain(self):
+        while True:
+            try:
+                pid, job_id, code, retiring = self.results.get_nowait()
+            except Empty:
+                return
+            self.running.pop(pid, None)
+            self.finished[job_id] = code
+            if retiring and (pid in self.workers):
+                self.retiring[pid] = self.workers.pop(pid)[0]
+
+    """Notes the jobs that finished and the workers that exited, failing
+       the job any of them died in, and replaces them
+    """
+    def check(self):
+        self.drain()
+        processes = [self.workers[pid][0] for pid in self.workers] + \
+            list(self.retiring.values())
+        exited = [worker for worker in processes if not worker.is_alive()]
+        if (len(exited) > 0):
+            # What they reported before exiting
+            self.drain()
+            for worker in exited:
+                worker.join()
+                self.workers.pop(worker.pid, None)
+                self.retiring.pop(worker.pid, None)
+                job_id = self.running.pop(worker.pid, None)
+                if (job_id is not None):
+                    self.finished[job_id] = worker.exitcode or -1
+        self.start()
+
+    def submit(self, job_id, input_file, key, profile=False):
+        self.check()
+        idle = [pid for pid in self.workers if pid not in self.running]
+        if (len(idle) == 0):
+            raise RuntimeError(f"No idle worker for job {job_id}")
+        self.running[idle[0]] = job_id
+        self.workers[idle[0]][1].put((job_id, input_file, key, profile))
+
+    """Jobs finished since the last call, {job_id: code}
+    """
+    def reap(self):
+        self.check()
+        finished = self.finished
+        self.finished = {}
+        return finished
+
+    def close(self):
+        for pid in self.workers:
+            self.workers[pid][1].put(None)
+        processes = [self.workers[pid][0] for pid in self.workers] + \
+            list(self.retiring.values())
+        for worker in processes:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = {}
+        self.retiring = {}
+
+
+"""Runs annotation jobs as child processes, at most max_jobs at a time,
+   and admits new ones only while the instance has cores, memory and
+   scratch space to spare for them
+   cores_per_job: cores a job is expected to keep busy (its shards)
+   pool: WorkerPool to run the jobs in; by default each job is a new
+   run_file process
+"""
+class JobExecutor(object):
+    def __init__(self, max_jobs, scratch, cores_per_job=1,
+        min_free_cores=0, min_free_memory=0, min_free_disk=0,
+        run_file='run.py', pool=None):
+        self.max_jobs = max_jobs
+        self.scratch = scratch
+        self.cores_per_job = cores_per_job
+        self.min_free_cores = min_free_cores
+        self.min_free_memory = min_free_memory
+        self.min_free_disk = min_free_disk
+        self.run_file = run_file
+        self.pool = pool
+        # Popen of each job, None for those run in the pool
+        self.jobs = {}
+
+    """Forgets the jobs that have finished; returns them, {job_id: code}
+    """
+    def reap(self):
+        finished = {}
+        pooled = self.pool.reap() if (self.pool is not None) else {}
+        for job_id in list(self.jobs):
+            job = self.jobs[job_id]
+            code = pooled.get(job_id) if (job is None) else job.poll()
+            if (code is not None):
+                del self.jobs[job_id]
+                finished[job_id] = code
+                if (code != 0):
+                    logging.error(f"Job {job_id} exited with {code}")
+                    print (f"Job {job_id} exited with {code}")
+        return finished
+
+    """Free cores: those not reserved by running jobs nor busy by the
+       1-minute load average
+    """
+    def freeCores(self):
+        busy = max(os.getloadavg()[0], len(self.jobs) * self.cores_per_job)
+        return multiprocessing.cpu_count() - busy
+
+    """Number of new jobs that may start now
+    """
+    def capacity(self):
+        slots = self.max_jobs - len(self.jobs)
+        if (slots <= 0):
+            return 0
+
+        # An idle instance always takes a job, however busy its cores are
+        cores = self.freeCores() - self.min_free_cores
+        if (len(self.jobs) > 0):
+            slots = min(slots, int(cores // self.cores_per_job))
+        else:
+            slots = min(slots, max(int(cores // self.cores_per_job), 1))
+        memory = availableMemory()
+        if (memory is not None) and (memory < self.min_free_memory):
+            return 0
+        if not os.path.exists(self.scratch):
+            os.makedirs(self.scratch)
+        free_disk = shutil.disk_usage(self.scratch).free // (1024 * 1024)
+        if (free_disk < self.min_free_disk):
+            return 0
+        return max(slots, 0)
+
+    def submit(self, job_id, input_file, key, profile=False):
+        if (self.pool is not None):
+            self.pool.submit(job_id, input_file, key, profile)
+            self.jobs[job_id] = None
+            return
+        args = [sys.executable, self.run_file, input_file, key]
+        if profile:
+            args.append('--profile')
+        self.jobs[job_id] = Popen(args)
+
+    """Waits up to timeout seconds for a running job to finish; returns
+       the jobs reaped meanwhile, as reap()
+    """
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while (time.time() < deadline):
+            finished = self.reap()
+            if (len(finished) > 0):
+                return finished
+            time.sleep(min(1, max(deadline - time.time(), 0)))
+        return {}
+
+
+# Longest visibility timeout SQS takes, in seconds
+MAX_VISIBILITY = 43200
+
+
+"""SQS messages of the jobs running on this instance. They are kept
+   invisible to other instances by extending their visibility every
+   interval seconds, and are deleted once their job has succeeded. The
+   message of a failed job is let go for this instance or another to
+   retry the job, after retry_delay seconds doubled with every earlier
+   receive; once it has been received max_receives times the job is
+   given up on instead: its message is deleted and settle() returns it
+   Receives are counted by SQS (ApproximateReceiveCount) and include
+   those of requests handed back while their user was at the cap
+"""
+class InFlightMessages(object):
+    def __init__(self, queue, visibility, interval, max_receives=10,
+        retry_delay=60):
+        self.queue = queue
+        self.visibility = visibility
+        self.interval = interval
+        self.max_receives = max_receives
+        self.retry_delay = retry_delay
+        self.last = time.time()
+        # Messages of each job; a request delivered twice has two
+        self.messages = {}
+
+    def add(self, job_id, msg):
+        self.messages.setdefault(job_id, []).append(msg)
+
+    """Times the messages of a job have been received, at least 1
+    """
+    def receives(self, job_id):
+        counts = [int((msg.attributes or {}).get('ApproximateReceiveCount', 1))
+            for msg in self.messages.get(job_id, [])]
+        return max(counts + [1])
+
+    """Deletes the messages of the jobs that succeeded and lets go of
+       those of the jobs that failed; finished is {job_id: code}
+       Returns the failed jobs given up on
+    """
+    def settle(self, finished):
+        given_up = []
+        for job_id in finished:
+            if (finished[job_id] != 0):
+                receives = self.receives(job_id)
+                if (receives < self.max_receives):
+                    self.release(job_id, min(MAX_VISIBILITY,
+                        self.retry_delay * 2 ** (receives - 1)))
+                    continue
+                given_up.append(job_id)
+            for msg in self.messages.pop(job_id, []):
+                try:
+                    msg.delete()
+                except ClientError as e:
+                    logging.error(e)
+                    print (e)
+        return given_up
+
+    """Stops holding the messages of a job and makes them visible again,
+       after delay seconds
+    """
+    def release(self, job_id, delay=0):
+        '''
+        Reference:
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Message.change_visibility
+        '''
+        for msg in self.messages.pop(job_id, []):
+            try:
+                msg.change_visibility(VisibilityTimeout=delay)
+            except ClientError as e:
+                logging.error(e)
+                print (e)
+
+    """Extends the visibility of the messages of running jobs, if it is
+       time to
+    """
+    def heartbeat(self):
+        if (time.time() - self.last < self.interval):
+            return
+        self.last = time.time()
+        messages = [msg for job_id in self.messages
+            for msg in self.messages[job_id]]
+        '''
+        Reference:
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.change_message_visibility_batch
+        '''
+        for i in range(0, len(messages), 10):
+            entries = [{'Id': str(n),
+                'ReceiptHandle': msg.receipt_handle,
+                'VisibilityTimeout': self.visibility}
+                for n, msg in enumerate(messages[i:i + 10])]
+            try:
+                response = self.queue.change_message_visibility_batch(
+                    Entries=entries)
+                for failed in response.get('Failed', []):
+                    logging.error(f"Visibility not extended: {failed}")
+                    print (f"Visibility not extended: {failed}")
+            except ClientError as e:
+                logging.error(e)
+                print (e)
+
+
+"""Requests received and not started yet, started in weighted fair order
+   between priority tiers: while several tiers wait, each gets a share of
+   the starts in proportion to its weight, ties going to the heavier. A
+   user has at most per_user jobs running; blocked() hands back their
+   other requests
+   weights: {tier: weight}; requests of no known tier go in the lightest
+"""
+class JobScheduler(object):
+    def __init__(self, weights, per_user):
+        self.weights = weights
+        self.tiers = sorted(weights, key=lambda tier: -weights[tier])
+        self.per_user = per_user
+        self.waiting = dict((tier, collections.deque()) for tier in weights)
+        # Virtual time of each tier; the next start goes to the lowest
+        self.passes = dict((tier, 0.0) for tier in weights)
+        self.clock = 0.0
+        # User of each running job
+        self.running = {}
+
+    def pending(self):
+        return sum(len(self.waiting[tier]) for tier in self.tiers)
+
+    """job: {'job_id', 'user_id', 'priority', ...}
+    """
+    def add(self, job):
+        tier = job.get('priority')
+        if (tier not in self.weights):
+            tier = self.tiers[-1]
+        # A tier that was idle gets no credit for the time it was
+        if (len(self.waiting[tier]) == 0):
+            self.passes[tier] = max(self.passes[tier], self.clock)
+        self.waiting[tier].append(job)
+
+    def knows(self, job_id):
+        if (job_id in self.running):
+            return True
+        return any((job['job_id'] == job_id) for tier in self.tiers
+            for job in self.waiting[tier])
+
+    def allowed(self, user_id):
+        running = sum(1 for user in self.running.values()
+            if (user == user_id))
+        return (running < self.per_user)
+
+    def eligible(self, tier):
+        for job in self.waiting[tier]:
+            if self.allowed(job['user_id']):
+                return job
+        return None
+
+    """Takes the waiting requests of the users at their cap of running
+       jobs
+    """
+    def blocked(self):
+        jobs = []
+        for tier in self.tiers:
+            for job in list(self.waiting[tier]):
+                if not self.allowed(job['user_id']):
+                    self.waiting[tier].remove(job)
+                    jobs.append(job)
+        return jobs
+
+    """Takes the job to start next, None if no job may start
+    """
+    def next(self):
+        best = None
+        for tier in self.tiers:
+            job = self.eligible(tier)
+            if (job is not None) and \
+                ((best is None) or (self.passes[tier] < self.passes[best[0]])):
+                best = (tier, job)
+        if (best is None):
+            return None
+        tier, job = best
+        self.waiting[tier].remove(job)
+        self.clock = self.passes[tier]
+        self.passes[tier] = self.passes[tier] + 1.0 / self.weights[tier]
+        self.running[job['job_id']] = job['user_id']
+        return job
+
+    """Forgets the jobs that finished, or failed to start; finished is
+       {job_id: code} as JobExecutor.reap() returns
+    """
+    def finish(self, finished):
+        for job_id in finished:
+            self.running.pop(job_id, None)
+
+
 def main(argv=None):
     '''
     Reference:
@@ -28,6 +473,31 @@ def main(argv=None):
     max_num_msg = int(config.get('SQS', 'MaxNumberOfMessages'))
     vis_timeout = int(config.get('SQS', 'VisibilityTimeout'))
     wait_sec = int(config.get('SQS', 'WaitTimeSeconds'))
+    heartbeat = int(config.get('SQS', 'HeartbeatInterval'))
+    max_receives = int(config.get('SQS', 'MaxReceiveCount'))
+    retry_delay = int(config.get('SQS', 'RetryDelay'))
+
+    MaxJobs = int(config.get('Executor', 'MaxJobs'))
+    pool = None
+    if config.getboolean('Executor', 'WarmWorkers'):
+        pool = WorkerPool(MaxJobs,
+            int(config.get('Executor', 'JobsPerWorker')),
+            int(config.get('Executor', 'MaxWorkerGrowthMB')))
+    executor = JobExecutor(MaxJobs, ResultFolder,
+        cores_per_job=int(config.get('Pipeline', 'Shards')),
+        min_free_cores=float(config.get('Executor', 'MinFreeCores')),
+        min_free_memory=int(config.get('Executor', 'MinFreeMemoryMB')),
+        min_free_disk=int(config.get('Executor', 'MinFreeDiskMB')),
+        run_file=RunFile, pool=pool)
+    reap_interval = int(config.get('Executor', 'ReapInterval'))
+    Streaming = config.getboolean('Streaming', 'Enabled')
+
+    scheduler = JobScheduler(
+        {'premium': int(config.get('Scheduling', 'PremiumWeight')),
+            'free': int(config.get('Scheduling', 'FreeWeight'))},
+        int(config.get('Scheduling', 'MaxJobsPerUser')))
+    lookahead = int(config.get('Scheduling', 'Lookahead'))
+    release_delay = int(config.get('Scheduling', 'ReleaseDelay'))
 
     # Connect to SQS and get the message queue
     '''
@@ -36,16 +506,126 @@ def main(argv=None):
     '''
     sqs = boto3.resource('sqs', region_name=AwsRegionName)
     queue = sqs.get_queue_by_name(QueueName=QName) 
+    # Messages stay on the queue, hidden, until their jobs are done
+    inflight = InFlightMessages(queue, vis_timeout, heartbeat,
+        max_receives, retry_delay)
+    # Messages of the requests waiting in the scheduler are held the same way
+    def settle(finished):
+        scheduler.finish(finished)
+        for job_id in inflight.settle(finished):
+            print (f"Job {job_id} failed {max_receives} times, giving up")
+            # Mark the job failed, unless a run of it did complete
+            '''
+            Reference:
+            https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+            '''
+            dynamodb = boto3.resource('dynamodb', region_name=AwsRegionName)
+            table = dynamodb.Table(DatabaseName)
+            try:
+                response = table.update_item(
+                        Key={'job_id': job_id},
+                        UpdateExpression='SET job_status=:val',
+                        ConditionExpression=Attr('job_status').is_in(
+                            ['PENDING', 'RUNNING']),
+                        ExpressionAttributeValues={':val':'FAILED'},
+                        ReturnValues='UPDATED_NEW'
+                        )
+            except ClientError as e:
+                logging.error(e)
+                print (e)
+
     # Poll the message queue in a loop
     while True:
-        # Attempt to read a message from the queue
-        # Use long polling - DO NOT use sleep() to wait between polls
-        messages = queue.receive_messages(
-                AttributeNames=['All'],
-                MaxNumberOfMessages=max_num_msg,
-                VisibilityTimeout=vis_timeout,
-                WaitTimeSeconds=wait_sec
-                )
+        settle(executor.reap())
+        inflight.heartbeat()
+
+        # Start what this instance has room for, in priority order
+        capacity = executor.capacity()
+        while (capacity > 0):
+            job = scheduler.next()
+            if (job is None):
+                break
+            job_id = job['job_id']
+            key = job['key']
+            directory = ResultFolder + '/' + key.split('/')[-1]
+
+            # Get the input file S3 object and copy it to a local file 
+            # Create folder ('results') in anntools to save the objects from s3
+            if not os.path.exists(ResultFolder):
+                os.makedirs(ResultFolder)
+
+            # The message of a job that could not be started is let go,
+            # for the job to be tried again
+            try:
+                # Download the input file from s3 to local; a streaming
+                # job reads its input from S3 itself
+                '''
+                Reference:
+                https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
+                ''' 
+                if not Streaming:
+                    s3 = boto3.client('s3', region_name=AwsRegionName)
+                    s3.download_file(InputBucket, key, directory)
+
+                # Launch annotation job in a warm worker, or as a
+                # background process; the job request may ask for the
+                # job to be profiled
+                '''
+                Reference:
+                https://pymotw.com/2/subprocess/
+                '''
+                executor.submit(job_id, directory, key, job['profile'])
+            except (ClientError, subprocess.SubprocessError, OSError,
+                RuntimeError) as e:
+                logging.error(e)
+                print (e)
+                settle({job_id: -1})
+                continue
+            capacity = capacity - 1
+
+            # Update the 'job_status' key in the database to running 
+            '''
+            Reference:
+            https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+            '''
+            dynamodb = boto3.resource('dynamodb', region_name=AwsRegionName)
+            table = dynamodb.Table(DatabaseName)
+            try:
+                response = table.update_item(
+                        Key={'job_id': job_id},
+                        UpdateExpression='SET job_status=:val',
+                        ConditionExpression=Attr('job_status').eq('PENDING'),
+                        ExpressionAttributeValues={':val':'RUNNING'},
+                        ReturnValues='UPDATED_NEW'
+                        )
+            except ClientError as e:
+                logging.error(e)
+                print (e)
+
+        # Requests of users at their cap go back to the queue, for other
+        # instances; after a delay, so this one does not take them again
+        for job in scheduler.blocked():
+            inflight.release(job['job_id'], release_delay)
+
+        # Hold at most lookahead requests more than can start, so that a
+        # premium one received behind free ones can go first while the
+        # rest of the queue stays visible to other instances; long poll
+        # only when there is nothing else to do
+        idle = (capacity > 0) and (scheduler.pending() == 0)
+        wanted = capacity + lookahead - scheduler.pending()
+        messages = []
+        if (wanted > 0):
+            # Attempt to read a message from the queue
+            # Use long polling - DO NOT use sleep() to wait between polls
+            messages = queue.receive_messages(
+                    AttributeNames=['All'],
+                    MaxNumberOfMessages=min(max_num_msg, wanted),
+                    VisibilityTimeout=vis_timeout,
+                    WaitTimeSeconds=wait_sec if idle else 0
+                    )
+        if (len(messages) == 0) and not idle:
+            settle(executor.wait(reap_interval))
+
         # If message read, extract job parameters from the message body as before
         if len(messages) > 0:
             print ("Received {0} messages...".format(str(len(messages))))
@@ -56,62 +636,23 @@ def main(argv=None):
                 # msg_rh = msg.receipt_handle
                 msg_body_m = json.loads(msg.body)['Message']
                 data = json.loads(msg_body_m) 
-                
-                # Get the input file S3 object and copy it to a local file 
-                # Create folder ('results') in anntools to save the objects from s3
-                if not os.path.exists(ResultFolder):
-                    os.makedirs(ResultFolder)
-
-                # Download the input file from s3 to local
-                '''
-                Reference:
-                https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
-                ''' 
-                s3 = boto3.client('s3', region_name=AwsRegionName)
                 key = data['s3_key_input_file']
                 filename = key.split('/')[-1]
                 id_fn = filename.split('~')
                 job_id = id_fn[0]
-                fn = id_fn[1]
-                directory = ResultFolder + '/' + filename
-                s3.download_file(InputBucket, key, directory)
-            
-                # Launch annotation job as a background process
-                '''
-                Reference:
-                https://pymotw.com/2/subprocess/
-                '''
-                try:
-                    process = Popen([sys.executable, RunFile, directory, key])
-                except subprocess.SubprocessError as e:
-                    logging.error(e)
-                    print (e)
 
-                # Update the 'job_status' key in the database to running 
-                '''
-                Reference:
-                https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-                '''
-                dynamodb = boto3.resource('dynamodb', region_name=AwsRegionName)
-                table = dynamodb.Table(DatabaseName)
-                try:
-                    response = table.update_item(
-                            Key={'job_id': job_id},
-                            UpdateExpression='SET job_status=:val',
-                            ConditionExpression=Attr('job_status').eq('PENDING'),
-                            ExpressionAttributeValues={':val':'RUNNING'},
-                            ReturnValues='UPDATED_NEW'
-                            )
-                except ClientError as e:
-                    logging.error(e)
-                    print (e)
-
-                # Delete the message from the queue, if job was successfully submitted
-                try: 
-                    msg.delete()
-                except Exception as e:
-                    logging.error(e)
-                    print (e)
+                # A request delivered again while it waits or runs here is
+                # settled with its job
+                known = scheduler.knows(job_id)
+                inflight.add(job_id, msg)
+                if known:
+                    continue
+                # Requests sent before they had a priority are free ones
+                scheduler.add({'job_id': job_id,
+                    'user_id': data.get('user_id'),
+                    'priority': data.get('priority', 'free'),
+                    'key': key,
+                    'profile': data.get('profile', False)})
 
 if __name__ == "__main__":
     sys.exit(main())
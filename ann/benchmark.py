@@ -0,0 +1,488 @@
+# benchmark.py
+#
+# Throughput benchmark of the annotation pipeline against a local SQLite
+# fixture of the reference database, so that it runs without RDS
+#
+# Builds a fixture with rows for every table driver.run touches, placed
+# around the variants of the inputs (data/*.vcf and synthetic scaled-up
+# copies), then times the full pipeline and each stage on its own, each
+# in a fresh process. Reports variants/sec, queries, rows fetched and
+# peak RSS as JSON, optionally compared against a stored baseline:
+#
+#   python benchmark.py --scale 10 --out bench.json
+#   python benchmark.py --scale 10 --baseline bench.json
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import resource
+import multiprocessing
+import utils as u
+import vcf_record as vr
+
+# Slowdown against the baseline reported as a regression
+TOLERANCE = 0.2
+
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+BIG_COLUMNS = ['id', 'CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand', 'positionType',
+    'frame', 'mrnaCoord', 'codonCoord', 'spliceDist', 'referenceCodon',
+    'referenceAA', 'variantCodon', 'variantAA', 'changesAA', 'functionalClass',
+    'codingCoordStr', 'proteinCoordStr', 'inCodingRegion', 'spliceInfo',
+    'uorfChange']
+
+POSITION_TYPES = ['intron', 'non_coding_intron', 'CDS', 'non_coding_exon',
+    'utr5', 'utr3']
+
+COMPLEMENT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+
+"""Writes a VCF with factor records per input record, at adjacent
+   positions, so that it stays sorted and close to real variants
+"""
+def scaleVcf(src, dest, factor):
+    with open(src) as fh, open(dest, 'w') as fh_out:
+        for line in fh:
+            if line.startswith('#'):
+                fh_out.write(line)
+                continue
+            fields = line.rstrip('\n').split('\t')
+            pos = int(fields[1])
+            for k in range(factor):
+                fields[1] = str(pos + k)
+                fh_out.write('\t'.join(fields) + '\n')
+
+
+def _variants(vcfs):
+    variants = {}
+    for vcf in vcfs:
+        with open(vcf) as fh:
+            for line in fh:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                variants.setdefault(fields[0].replace('chr', ''), []).append(
+                    (int(fields[1]), fields[3], fields[4]))
+    return variants
+
+
+"""Builds the SQLite fixture at path, with rows around the variants of
+   vcfs; density scales the number of interval rows per variant
+"""
+def buildFixture(path, vcfs, density=1.0, seed=7):
+    rnd = random.Random(seed)
+    variants = _variants(vcfs)
+    chroms = sorted(variants)
+
+    def near(chrom, spread):
+        return max(1, rnd.choice(variants[chrom])[0] +
+            rnd.randint(-spread, spread))
+
+    def count(chrom, per):
+        return max(3, int(len(variants[chrom]) * density / per))
+
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    c = db.cursor()
+
+    c.execute('create table dbSNP (CHR text, POS int, REF text, rsID text, ' + \
+        'ALT text, QUAL text, FILTER text, GMAF text, INFO text)')
+    n = 0
+    for chrom in chroms:
+        for (pos, ref, alt) in variants[chrom]:
+            if (rnd.random() < 0.5):
+                for k in range(rnd.choice([1, 1, 1, 2])):
+                    n = n + 1
+                    r = ref if (rnd.random() < 0.8) else COMPLEMENT.get(ref, ref)
+                    gmaf = '.' if (rnd.random() < 0.3) else \
+                        '%.3f' % rnd.random()
+                    c.execute('insert into dbSNP values (?,?,?,?,?,?,?,?,?)',
+                        (chrom, pos, r, 'rs' + str(n), alt, '.', '.', gmaf,
+                        'SNV' if (rnd.random() < 0.9) else 'DIV'))
+
+    rid = [0]
+    def bigRow(chrom, start, end, ref, alt):
+        rid[0] = rid[0] + 1
+        g = rnd.randint(1, 50)
+        return [rid[0], chrom, start, end, ref, alt, 'NM_' + str(g),
+            'GENE' + str(g), rnd.choice('+-'), rnd.choice(POSITION_TYPES),
+            rnd.choice([0, 1, 2]), rnd.randint(0, 3000), rnd.randint(0, 1000),
+            rnd.choice([0, 0, 5, -3]), 'ATG', 'M', 'ACG', 'T',
+            rnd.choice(['0', 'True', '']),
+            rnd.choice(['missense', 'silent', 'nonsense']),
+            'c.' + str(g) + 'A>G', 'p.M' + str(g) + 'T', rnd.choice(['0', '1']),
+            '', '0']
+
+    insert = ' values (' + ','.join(['?'] * len(BIG_COLUMNS)) + ')'
+    for t in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        c.execute('create table ' + t + ' (' + ', '.join(BIG_COLUMNS) + ')')
+    for chrom in chroms:
+        for (pos, ref, alt) in variants[chrom]:
+            x = rnd.random()
+            if (x < 0.2):
+                c.execute('insert into chrom_pos_equal_base' + insert,
+                    bigRow(chrom, pos, pos, ref, alt))
+            elif (x < 0.35):
+                c.execute('insert into chrom_pos_equal_nobase' + insert,
+                    bigRow(chrom, pos, pos, '', ''))
+        for k in range(count(chrom, 10)):
+            start = near(chrom, 2000)
+            c.execute('insert into chrom_pos_unequal' + insert,
+                bigRow(chrom, start, start + rnd.randint(0, 3000), '', ''))
+
+    c.execute('create table refGene (bin int, name text, chrom text, ' + \
+        'strand text, txStart int, txEnd int, cdsStart int, cdsEnd int, ' + \
+        'exonCount int, exonStarts blob, exonEnds blob, score int, ' + \
+        'name2 text, cdsStartStat text, cdsEndStat text, exonFrames blob)')
+    c.execute('create table cpgIslandExt (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text)')
+    for chrom in chroms:
+        for k in range(count(chrom, 8)):
+            txStart = near(chrom, 20000)
+            starts = []
+            ends = []
+            pos = txStart
+            for e in range(rnd.choice([1, 2, 3, 5, 8, 20, 150])):
+                start = pos + rnd.randint(0, 300)
+                pos = start + rnd.randint(20, 400)
+                starts.append(start)
+                ends.append(pos)
+                pos = pos + rnd.randint(1, 2000)
+            txEnd = ends[-1]
+            cdsStart = cdsEnd = txEnd
+            if (rnd.random() < 0.75):
+                cdsStart = rnd.randint(txStart, (txStart + txEnd) // 2)
+                cdsEnd = rnd.randint(cdsStart, txEnd)
+            g = rnd.randint(1, 80)
+            c.execute('insert into refGene values ' + \
+                '(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (0,
+                'NM_' + str(rnd.randint(1, 9999)), 'chr' + chrom,
+                rnd.choice('+-'), txStart, txEnd, cdsStart, cdsEnd,
+                len(starts), (','.join(map(str, starts)) + ',').encode(),
+                (','.join(map(str, ends)) + ',').encode(), 0,
+                'GENE' + str(g), 'cmpl', 'cmpl', b'0,'))
+            for edge in [txStart, txEnd]:
+                if (rnd.random() < 0.7):
+                    start = edge - rnd.randint(-100, 600)
+                    c.execute('insert into cpgIslandExt values (?,?,?,?,?)',
+                        (0, 'chr' + chrom, start, start + rnd.randint(50, 900),
+                        'CpG: ' + str(rnd.randint(10, 200))))
+
+    c.execute('create table cytoBand (chrom text, chromStart int, ' + \
+        'chromEnd int, name text, gieStain text)')
+    for chrom in chroms:
+        start = 0
+        for k in range(60):
+            end = start + rnd.randint(200000, 4000000)
+            c.execute('insert into cytoBand values (?,?,?,?,?)',
+                ('chr' + chrom, start, end, 'p' + str(k), 'gneg'))
+            start = end
+
+    c.execute('create table gadAll (chromosome text, chromStart int, ' + \
+        'chromEnd int, geneSymbol text, x text)')
+    c.execute('create table gwasCatalog (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, pubMedID text, ' + \
+        'author text, pubDate text, journal text, title text, trait text)')
+    c.execute('create table hugo (chrom text, chromStart int, chromEnd int, ' + \
+        'bin int, name text, approvedSymbol text, approvedName text)')
+    c.execute('create table genomicSuperDups (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, score int, strand text, ' + \
+        'otherChrom text, otherStart int, otherEnd int)')
+    for t in CNV_TABLES:
+        c.execute('create table ' + t + ' (chrom text, chromStart int, ' + \
+            'chromEnd int, name text)')
+    c.execute('create table targetScanS (bin int, chrom text, ' + \
+        'chromStart int, chromEnd int, name text, score int, strand text)')
+    for t in TFBS_CHROMS:
+        c.execute('create table tfbsConsSites' + t + ' (bin int, ' + \
+            'chrom text, chromStart int, chromEnd int, name text, score int)')
+
+    for chrom in chroms:
+        for k in range(count(chrom, 5)):
+            start = near(chrom, 5000)
+            c.execute('insert into gadAll values (?,?,?,?,?)', (chrom, start,
+                start + rnd.randint(0, 20000),
+                rnd.choice(['BRCA1', 'TP53', 'APOE', 'CFTR', 'MTHFR']), ''))
+            start = near(chrom, 5000)
+            c.execute('insert into hugo values (?,?,?,?,?,?,?)', ('chr' + chrom,
+                start, start + rnd.randint(0, 50000), 0, 'h',
+                'SYM' + str(rnd.randint(1, 30)), 'gene name'))
+            start = near(chrom, 5000)
+            c.execute('insert into genomicSuperDups values ' + \
+                '(?,?,?,?,?,?,?,?,?,?)', (0, 'chr' + chrom, start,
+                start + rnd.randint(0, 30000), 'sd', 1, '+', 'chr1', 1, 2))
+            for t in CNV_TABLES:
+                if (rnd.random() < 0.5):
+                    start = near(chrom, 5000)
+                    c.execute('insert into ' + t + ' values (?,?,?,?)',
+                        ('chr' + chrom, start, start + rnd.randint(0, 40000),
+                        'cnv'))
+            start = near(chrom, 100)
+            c.execute('insert into targetScanS values (?,?,?,?,?,?,?)',
+                (0, 'chr' + chrom, start, start + rnd.randint(0, 200),
+                'miR-' + str(rnd.randint(1, 500)), 80, '+'))
+            if (chrom in TFBS_CHROMS):
+                start = near(chrom, 100)
+                c.execute('insert into tfbsConsSites' + chrom + \
+                    ' values (?,?,?,?,?,?)', (0, 'chr' + chrom, start,
+                    start + rnd.randint(0, 200),
+                    'V$TF' + str(rnd.randint(1, 50)), 900))
+        for (pos, ref, alt) in variants[chrom]:
+            if (rnd.random() < 0.03):
+                c.execute('insert into gwasCatalog values ' + \
+                    '(?,?,?,?,?,?,?,?,?,?,?)', (0, 'chr' + chrom, pos - 1, pos,
+                    'rs', '1', 'a', 'd', 'j', 't', 'Height'))
+
+    # The indexes the annotators' lookups rely on in the reference database
+    c.execute('create index dbSNP_pos on dbSNP (CHR, POS)')
+    for t in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        c.execute('create index ' + t + '_pos on ' + t + ' (CHR, start, end)')
+    c.execute('create index refGene_pos on refGene (chrom, txStart, txEnd)')
+    c.execute('create index gadAll_pos on gadAll ' + \
+        '(chromosome, chromStart, chromEnd)')
+    for t in ['cpgIslandExt', 'cytoBand', 'gwasCatalog', 'hugo',
+        'genomicSuperDups', 'targetScanS'] + CNV_TABLES:
+        c.execute('create index ' + t + '_pos on ' + t + \
+            ' (chrom, chromStart, chromEnd)')
+    db.commit()
+    db.close()
+
+
+"""Cursor counting the queries and rows of the fixture connection
+"""
+class CountingCursor(object):
+    queries = 0
+    rows = 0
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, *args):
+        CountingCursor.queries = CountingCursor.queries + 1
+        return self.cursor.execute(sql, *args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if (row is not None):
+            CountingCursor.rows = CountingCursor.rows + 1
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        CountingCursor.rows = CountingCursor.rows + len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            CountingCursor.rows = CountingCursor.rows + 1
+            yield row
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Stand-in for the pooled reference database connection
+"""
+class FixtureConnection(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+
+    def cursor(self, cursorclass=None):
+        return CountingCursor(self.db.cursor())
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+    def discard(self):
+        self.db.close()
+
+
+def _useFixture(path):
+    u.db_connect = lambda *args, **kwargs: FixtureConnection(path)
+
+
+def _measure(start, cpu):
+    return {'seconds': time.time() - start,
+        'cpu_seconds': time.process_time() - cpu,
+        'queries': CountingCursor.queries,
+        'rows': CountingCursor.rows,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+"""Child process: the full pipeline over a copy of vcf
+"""
+def _runPipeline(task):
+    fixture, vcf, workdir = task
+    _useFixture(fixture)
+    import driver
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    target = os.path.join(workdir, os.path.basename(vcf))
+    shutil.copy(vcf, target)
+    start = time.time()
+    cpu = time.process_time()
+    driver.run(target, 'vcf')
+    return _measure(start, cpu)
+
+
+"""Child process: stage number n alone, over records annotated by the
+   stages before it
+"""
+def _runStage(task):
+    fixture, n, records = task
+    _useFixture(fixture)
+    import driver
+    stage = driver.getStages()[n]
+    start = time.time()
+    cpu = time.process_time()
+    stage.open()
+    for i in range(0, len(records), driver.CHUNK_SIZE):
+        driver.annotateChunk([stage], records[i:i + driver.CHUNK_SIZE])
+    stage.close()
+    return _measure(start, cpu)
+
+
+def _inChild(function, task):
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    result = pool.apply(function, (task,))
+    pool.close()
+    pool.join()
+    return result
+
+
+def _rate(result, variants):
+    result['variants'] = variants
+    result['variants_per_sec'] = variants / max(result['seconds'], 1e-9)
+    return result
+
+
+"""Benchmarks one input: the pipeline and every stage
+"""
+def benchmarkInput(fixture, vcf, workdir):
+    _useFixture(fixture)
+    import driver
+    records = []
+    with open(vcf) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line.startswith('#'):
+                records.append(vr.VcfRecord(line.split('\t')))
+
+    result = {'pipeline': _rate(_inChild(_runPipeline,
+        (fixture, vcf, workdir)), len(records)), 'stages': {}}
+
+    stages = driver.getStages()
+    for n in range(len(stages)):
+        result['stages'][stages[n].name] = _rate(_inChild(_runStage,
+            (fixture, n, records)), len(records))
+        # Input of the next stage
+        stages[n].open()
+        for i in range(0, len(records), driver.CHUNK_SIZE):
+            driver.annotateChunk([stages[n]], records[i:i + driver.CHUNK_SIZE])
+        stages[n].close()
+    return result
+
+
+"""Lines comparing variants/sec of results against baseline; a drop of
+   more than TOLERANCE is flagged
+"""
+def compare(results, baseline):
+    lines = []
+    regressions = 0
+    for name in sorted(results['inputs']):
+        if (name not in baseline['inputs']):
+            continue
+        new = results['inputs'][name]
+        old = baseline['inputs'][name]
+        pairs = [('pipeline', new['pipeline'], old['pipeline'])]
+        for stage in new['stages']:
+            if (stage in old['stages']):
+                pairs.append((stage, new['stages'][stage],
+                    old['stages'][stage]))
+        for label, a, b in pairs:
+            ratio = a['variants_per_sec'] / max(b['variants_per_sec'], 1e-9)
+            flag = ''
+            if (ratio < 1 - TOLERANCE):
+                flag = '  REGRESSION'
+                regressions = regressions + 1
+            lines.append(f"{name} {label}: {a['variants_per_sec']:.0f} " + \
+                f"variants/sec ({ratio:.2f}x baseline), queries " + \
+                f"{a['queries']} ({b['queries']}){flag}")
+    return lines, regressions
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline')
+    parser.add_argument('vcf', nargs='*',
+        default=sorted(glob.glob(os.path.join(here, 'data', '*.vcf'))))
+    parser.add_argument('--scale', type=int, default=10,
+        help='records per input record in the synthetic inputs')
+    parser.add_argument('--density', type=float, default=1.0,
+        help='scales the interval rows of the fixture')
+    parser.add_argument('--workdir', default='benchmark_work')
+    parser.add_argument('--out', help='write the results to this file')
+    parser.add_argument('--baseline', help='results to compare against')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    inputs = list(args.vcf)
+    if (args.scale > 1):
+        for vcf in args.vcf:
+            name = os.path.basename(vcf).replace('.vcf', '') + \
+                '_x' + str(args.scale) + '.vcf'
+            scaleVcf(vcf, os.path.join(args.workdir, name), args.scale)
+            inputs.append(os.path.join(args.workdir, name))
+
+    fixture = os.path.join(args.workdir, 'reference.sqlite')
+    buildFixture(fixture, inputs, density=args.density)
+
+    results = {'scale': args.scale, 'density': args.density, 'inputs': {}}
+    for vcf in inputs:
+        name = os.path.basename(vcf)
+        print(f"Benchmarking {name} . . .")
+        results['inputs'][name] = benchmarkInput(fixture, vcf,
+            os.path.join(args.workdir, 'jobs'))
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            lines, regressions = compare(results, json.load(fh))
+        for l in lines:
+            print(l)
+        if (regressions > 0):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+### EOF
@@ -0,0 +1,140 @@
+# bgzf.py
+#
+# Compressed VCF input and output. Input may be plain, gzip or BGZF and is
+# decompressed as it is read; output is written as BGZF (blocked gzip, as
+# produced by bgzip), which any gzip reader can decompress and which can be
+# indexed by virtual offset (see tabix.py)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import zlib
+import struct
+
+# Uncompressed bytes per block, as used by htslib, so that a compressed
+# block always fits the 16-bit block size field
+BLOCK_SIZE = 65280
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# gzip member header with the 'BC' extra subfield holding the block size
+HEADER = struct.Struct('<BBBBIBBHBBHH')
+
+# File name suffixes of compressed inputs and outputs
+SUFFIXES = ['.gz', '.bgz']
+
+
+"""True if path is gzip (or BGZF) compressed
+"""
+def isCompressed(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
+
+
+"""Opens a VCF for reading text lines, decompressing it if needed
+"""
+def openText(path):
+    if isCompressed(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""path without a compressed file suffix
+"""
+def stripSuffix(path):
+    for suffix in SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+"""Text file writer producing BGZF blocks
+   tell() returns the virtual offset of the next byte written:
+   (offset of its block in the file << 16) | offset within the block
+   fh, a binary file object (s3_stream.S3Writer), is written instead of
+   path
+"""
+class BgzfWriter(object):
+    def __init__(self, path, level=6, fh=None):
+        self.fh = fh if (fh is not None) else open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        self.buffer.extend(text)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self._writeBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def tell(self):
+        return (self.fh.tell() << 16) | len(self.buffer)
+
+    def _writeBlock(self, data):
+        deflate = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = deflate.compress(data) + deflate.flush()
+        self.fh.write(HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+            len(cdata) + HEADER.size + 8 - 1))
+        self.fh.write(cdata)
+        self.fh.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+            len(data)))
+
+    def close(self):
+        if (len(self.buffer) > 0):
+            self._writeBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Reads BGZF blocks from a binary file object positioned at the start of
+   a block; yields (offset of the block, uncompressed data) and stops at
+   the end of the data or at a truncated block
+"""
+def iterBlocks(fh, offset=0):
+    while True:
+        header = fh.read(HEADER.size)
+        if (len(header) < HEADER.size):
+            return
+        fields = HEADER.unpack(header)
+        if (fields[0:4] != (31, 139, 8, 4)) or (fields[8:10] != (66, 67)):
+            raise IOError('not a BGZF block at offset ' + str(offset))
+        size = fields[11] + 1
+        rest = fh.read(size - HEADER.size)
+        if (len(rest) < size - HEADER.size):
+            return
+        yield offset, zlib.decompress(rest[:-8], -15)
+        offset = offset + size
+
+
+"""Opens an output file for writing text, as BGZF if compress is True
+   fh, a file object taking text and bytes, is written instead of path
+"""
+def openOutput(path, compress=False, fh=None):
+    if compress:
+        return BgzfWriter(path, fh=fh)
+    if (fh is not None):
+        return fh
+    return open(path, 'w')
+
+
+"""Compresses the text file src into the BGZF file dest
+"""
+def compressFile(src, dest):
+    with open(src) as fh, BgzfWriter(dest) as fh_out:
+        while True:
+            block = fh.read(BLOCK_SIZE)
+            if not block:
+                break
+            fh_out.write(block)
+
+### EOF
@@ -0,0 +1,184 @@
+# dbsnp_index.py
+#
+# Memory-mapped dbSNP membership index, exported once from the reference
+# database so that dbSNP lookups need no database traffic
+#
+# One file per chromosome, <CHR>.dbsnp, laid out as
+#   header   magic, record count n, string table size (struct HEADER)
+#   POS      n unsigned 32-bit positions, sorted ascending
+#   offsets  n + 1 unsigned 32-bit offsets into the string table
+#   strings  'REF\trsID\tGMAF\tINFO' per record, UTF-8
+# The header and the arrays are all little-endian; a big-endian host
+# swaps the arrays into memory on open instead of mapping them. A
+# 'manifest' file listing the chromosomes is written last and marks the
+# index as complete.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import mmap
+import array
+import bisect
+import struct
+
+MAGIC = b'DBSNPIX1'
+HEADER = struct.Struct('<8sII')
+MANIFEST = 'manifest'
+
+# Opened indexes, shared by all jobs run in this process
+_indexes = {}
+
+
+"""Little-endian unsigned 32-bit integers in data, as a sequence
+"""
+def _uint32(data):
+    if (sys.byteorder == 'little'):
+        return data.cast('I')
+    values = array.array('I', data.tobytes())
+    values.byteswap()
+    return values
+
+
+"""Read-only view of one chromosome file
+"""
+class ChromIndex(object):
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, size = HEADER.unpack_from(self.mm, 0)
+        if (magic != MAGIC):
+            raise IOError(f"{path} is not a dbSNP index file")
+
+        view = memoryview(self.mm)
+        start = HEADER.size
+        self.positions = _uint32(view[start:start + 4 * n])
+        start = start + 4 * n
+        self.offsets = _uint32(view[start:start + 4 * (n + 1)])
+        self.strings = start + 4 * (n + 1)
+
+    """[(REF, rsID, GMAF, INFO), ...] at pos, in database order
+    """
+    def lookup(self, pos):
+        records = []
+        i = bisect.bisect_left(self.positions, pos)
+        while (i < len(self.positions)) and (self.positions[i] == pos):
+            start = self.strings + self.offsets[i]
+            end = self.strings + self.offsets[i + 1]
+            records.append(tuple(self.mm[start:end].decode('utf-8').split('\t')))
+            i = i + 1
+        return records
+
+
+"""All chromosome files of an index directory, opened on first use
+"""
+class DbSnpIndex(object):
+    def __init__(self, directory):
+        self.directory = directory
+        manifest = os.path.join(directory, MANIFEST)
+        if not os.path.isfile(manifest):
+            raise IOError(f"dbSNP index in '{directory}' is incomplete")
+        with open(manifest) as fh:
+            self.chroms = set([l.strip() for l in fh if len(l.strip()) > 0])
+        self.opened = {}
+
+    def lookup(self, chrom, pos):
+        if chrom not in self.chroms:
+            return []
+        index = self.opened.get(chrom)
+        if (index is None):
+            index = ChromIndex(os.path.join(self.directory, chrom + '.dbsnp'))
+            self.opened[chrom] = index
+        return index.lookup(pos)
+
+
+"""Returns the index in directory, opened once per process
+"""
+def getIndex(directory):
+    index = _indexes.get(directory)
+    if (index is None):
+        index = DbSnpIndex(directory)
+        _indexes[directory] = index
+    return index
+
+
+def _writeChrom(path, records):
+    positions = array.array('I')
+    offsets = array.array('I', [0])
+    tmp = path + '.strings'
+    size = 0
+    with open(tmp, 'wb') as fh_str:
+        for pos, text in records:
+            data = text.encode('utf-8')
+            fh_str.write(data)
+            size = size + len(data)
+            positions.append(pos)
+            offsets.append(size)
+
+    if (sys.byteorder != 'little'):
+        positions.byteswap()
+        offsets.byteswap()
+    with open(path + '.tmp', 'wb') as fh_out, open(tmp, 'rb') as fh_str:
+        fh_out.write(HEADER.pack(MAGIC, len(positions), size))
+        fh_out.write(positions.tobytes())
+        fh_out.write(offsets.tobytes())
+        while True:
+            block = fh_str.read(1 << 20)
+            if not block:
+                break
+            fh_out.write(block)
+    os.unlink(tmp)
+    os.rename(path + '.tmp', path)
+
+
+def _clean(value):
+    return str(value).replace('\t', ' ').strip()
+
+
+"""Exports dbSNP from the reference database into directory
+   conn should support unbuffered cursors (pymysql SSCursor) so that a
+   chromosome is streamed rather than fetched into memory
+"""
+def build(conn, directory, cursorclass=None):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    cursor = conn.cursor()
+    cursor.execute('select distinct CHR from dbSNP;')
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+    cursor.close()
+
+    for chrom in chroms:
+        cursor = conn.cursor(cursorclass) if cursorclass else conn.cursor()
+        # rsID and GMAF are columns 3 and 7 of the table, as in annotate.py
+        cursor.execute('select POS, REF, INFO, dbSNP.* from dbSNP ' + \
+            'where CHR="' + chrom + '" order by POS;')
+
+        def records():
+            for row in cursor:
+                yield (int(row[0]), _clean(row[1]) + '\t' + \
+                    _clean(row[3 + 3]) + '\t' + _clean(row[3 + 7]) + '\t' + \
+                    _clean(row[2]))
+
+        _writeChrom(os.path.join(directory, chrom + '.dbsnp'), records())
+        cursor.close()
+        print(f"dbSNP index: chromosome {chrom} - done.")
+
+    with open(os.path.join(directory, MANIFEST + '.tmp'), 'w') as fh:
+        fh.write('\n'.join(chroms) + '\n')
+    os.rename(os.path.join(directory, MANIFEST + '.tmp'),
+        os.path.join(directory, MANIFEST))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import pymysql
+        import utils as u
+        conn = u.db_connect()
+        build(conn, sys.argv[1], cursorclass=pymysql.cursors.SSCursor)
+        conn.close()
+    else:
+        print('usage: python dbsnp_index.py <index directory>')
+
+### EOF
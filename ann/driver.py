@@ -12,110 +12,459 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import multiprocessing
 import file_utils as fu
+import utils as u
 import annotate as ann
+import annotation_cache as ac
+import metrics as mt
+import bgzf
+import vcf_record as vr
+import pileup2vcf
 
-def run(infile, format):
+# Number of records parsed and passed through the stages at a time
+CHUNK_SIZE = 5000
 
-    print("Running . . .")
+# Number of positions resolved per dbSNP query
+DBSNP_BATCH_SIZE = 5000
+
+# Chromosomes holding more than their share of a sharded job are split
+# into ranges of this many bases
+SHARD_RANGE = 10000000
+
+# Processes converting a pileup input to VCF
+PILEUP_PROCESSES = int(os.environ['ANN_PILEUP_PROCESSES']) if \
+    ('ANN_PILEUP_PROCESSES' in os.environ) else multiprocessing.cpu_count()
+
+# Directory built by dbsnp_index.py; dbSNP is then looked up locally
+DBSNP_INDEX_DIR = os.environ['ANN_DBSNP_INDEX_DIR'] if \
+    ('ANN_DBSNP_INDEX_DIR' in os.environ) else None
+
+
+"""Annotation stages, in the order they are applied
+   sweep=True streams the overlap tables instead of indexing them
+   (see annotate.RangeStage); the input should be sorted by position
+"""
+def getStages(sweep=False):
+    return [
+        ann.DbSnpStage(format='vcf', batchsize=DBSNP_BATCH_SIZE,
+            index_dir=DBSNP_INDEX_DIR),
+        ann.BigRefGeneStage(format='vcf'),
+        ann.GenesStage(format='vcf', table='refGene', promoter_offset=500),
+        ann.CytobandStage(format='vcf', table='cytoBand', sweep=sweep),
+        ann.GadAllStage(format='vcf', table='gadAll', sweep=sweep),
+        ann.GwasCatalogStage(format='vcf', table='gwasCatalog'),
+        ann.MiRNAStage(format='vcf', table='targetScanS', sweep=sweep),
+        ann.HUGOGeneNomenclatureStage(format='vcf', table='hugo', sweep=sweep),
+        ann.CnvDatabaseStage(format='vcf', table='dgv_Cnv', sweep=sweep),
+        ann.CnvDatabaseStage(format='vcf', table='abParts_IG_T_CelReceptors',
+            sweep=sweep),
+        ann.CnvDatabaseStage(format='vcf', table='mcCarroll_Cnv', sweep=sweep),
+        ann.CnvDatabaseStage(format='vcf', table='conrad_Cnv', sweep=sweep),
+        ann.GenomicSuperDupsStage(format='vcf', table='genomicSuperDups',
+            sweep=sweep),
+        ann.TfbsConsSitesStage(format='vcf', table='tfbsConsSites',
+            sweep=sweep)]
+
+
+"""Key of the reference data and stage setup behind an annotation, for
+   the annotation cache
+"""
+def cacheVersion(version, stages, sweep=False):
+    return '|'.join([str(version)] +
+        [stage.name + ':' + str(stage.table) for stage in stages] +
+        ['sweep' if sweep else 'index'])
+
+
+"""Opens the annotation cache described by cache, the keyword arguments
+   of run(); None if there is none
+"""
+def openCache(cache, stages, sweep=False):
+    if (cache is None):
+        return None
+    return ac.AnnotationCache(cache['path'],
+        cacheVersion(cache['version'], stages, sweep),
+        max_bytes=cache.get('max_bytes', 512 * 1024 * 1024))
+
+
+"""Runs one stage over a chunk; metrics, a metrics.JobMetrics, records
+   what it took
+"""
+def annotateStage(stage, chunk, sep='\t', metrics=None):
+    if (metrics is not None):
+        metrics.start(stage, chunk)
+    stage.annotateChunk(chunk)
+    for record in chunk:
+        record.restrip(sep)
+    if (metrics is not None):
+        metrics.stop(stage, chunk)
+
+
+"""Same as annotateChunk() without a cache, returning each stage's counter
+   changes per record ([stage][record]), or None if a stage did not report
+   them
+"""
+def annotateTraced(stages, chunk, sep='\t', metrics=None):
+    deltas = []
+    for stage in stages:
+        previous = dict(stage.counts)
+        stage.tally = []
+        annotateStage(stage, chunk, sep=sep, metrics=metrics)
+        tally = stage.tally
+        stage.tally = None
+
+        if (deltas is None) or (len(tally) != len(chunk)):
+            deltas = None
+            continue
+        changes = []
+        for counts in tally:
+            changes.append(dict([(k, counts[k] - previous.get(k, 0))
+                for k in counts if counts[k] != previous.get(k, 0)]))
+            previous = counts
+        deltas.append(changes)
+    return deltas
+
+
+"""cache: an annotation_cache.AnnotationCache; records found in it are
+   annotated from it and the others are annotated and added to it
+"""
+def annotateChunk(stages, chunk, sep='\t', cache=None, metrics=None):
+    if (metrics is not None):
+        metrics.variants = metrics.variants + len(chunk)
+    if (cache is None):
+        for stage in stages:
+            annotateStage(stage, chunk, sep=sep, metrics=metrics)
+        return
+
+    keys = [cache.key(record) for record in chunk]
+    found = cache.getMany(keys)
+    cache.lookups = cache.lookups + len(chunk)
+
+    misses = [i for i in range(len(chunk)) if keys[i] not in found]
+    originals = [chunk[i].copy() for i in misses]
+    deltas = annotateTraced(stages, [chunk[i] for i in misses], sep=sep,
+        metrics=metrics)
+
+    for i in range(len(chunk)):
+        entry = found.get(keys[i])
+        if (entry is not None):
+            cache.apply(chunk[i], entry)
+            for stage, counts in zip(stages, entry['counts']):
+                for k in counts:
+                    stage.counts[k] = stage.counts[k] + counts[k]
+            cache.hits = cache.hits + 1
+
+    if (deltas is not None):
+        entries = {}
+        for j in range(len(misses)):
+            entry = cache.entry(originals[j], chunk[misses[j]],
+                [changes[j] for changes in deltas])
+            if (entry is not None):
+                entries[keys[misses[j]]] = entry
+        cache.putMany(entries)
+
+
+"""'pileup' for samtools variant pileups (.pileup, .pileup.gz), else 'vcf'
+"""
+def inputFormat(infile):
+    if bgzf.stripSuffix(infile).endswith('.pileup'):
+        return 'pileup'
+    return 'vcf'
+
+
+"""Lines of the input as VCF; a pileup is converted as it is read
+"""
+def openInput(infile, format='vcf'):
+    if (format == 'pileup'):
+        return pileup2vcf.PileupReader(infile, processes=PILEUP_PROCESSES)
+    return bgzf.openText(infile)
+
+
+"""Parses the input once, passes the records through every stage in
+   memory and writes the annotated file and the count log once
+"""
+def runPipeline(infile, outfile, stages, chunksize=CHUNK_SIZE, sep='\t',
+    cache=None, compress=False, logfile=None, metrics=None, format='vcf',
+    source=None, sink=None):
+    fh = source if (source is not None) else openInput(infile, format)
+    fh_out = bgzf.openOutput(outfile, compress, sink)
+    conn = u.db_connect()
+    for stage in stages:
+        stage.open(conn)
+
+    chunk = []
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            if (len(chunk) > 0):
+                annotateChunk(stages, chunk, sep=sep, cache=cache,
+                    metrics=metrics)
+                for record in chunk:
+                    fh_out.write(record.line() + '\n')
+                chunk = []
+            fh_out.write(line + '\n')
+        else:
+            chunk.append(vr.VcfRecord(line.split(sep)))
+            if (len(chunk) >= chunksize):
+                annotateChunk(stages, chunk, sep=sep, cache=cache,
+                    metrics=metrics)
+                for record in chunk:
+                    fh_out.write(record.line() + '\n')
+                chunk = []
+
+    if (len(chunk) > 0):
+        annotateChunk(stages, chunk, sep=sep, cache=cache,
+            metrics=metrics)
+        for record in chunk:
+            fh_out.write(record.line() + '\n')
+
+    for stage in stages:
+        stage.close()
+    conn.close()
+    fh.close()
+    fh_out.close()
+
+    writeCountLog(logfile or (infile + '.count.log'), stages, cache=cache)
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+
+def writeCountLog(logfile, stages, cache=None):
+    fh_log = open(logfile, 'w')
+    for stage in stages:
+        for l in stage.summary():
+            fh_log.write(l + '\n')
+        print(f"{stage.name} - done.")
+    if (cache is not None):
+        for l in cache.summary():
+            fh_log.write(l + '\n')
+            print(l)
+    fh_log.close()
+
+
+"""Splits the records of a job into work units: one per chromosome, or
+   one per SHARD_RANGE bases of a chromosome holding more than its share
+"""
+def getShards(records, shards):
+    share = len(records) / float(shards)
+    chroms = {}
+    for i in range(len(records)):
+        chroms.setdefault(records[i].chrom, []).append(i)
+
+    units = []
+    for chrom in chroms:
+        members = chroms[chrom]
+        if (len(members) > share):
+            ranges = {}
+            for i in members:
+                ranges.setdefault(int(records[i].pos) // SHARD_RANGE,
+                    []).append(i)
+            units.extend([ranges[r] for r in sorted(ranges)])
+        else:
+            units.append(members)
+
+    # Largest first, so the pool finishes evenly
+    units.sort(key=len, reverse=True)
+    return units
+
+
+"""Pool worker: annotates one unit with its own stages and connection
+   Returns the stage metrics of the unit if metered, else None
+"""
+def annotateShard(task):
+    n, records, sweep, cache, metered = task
+    stages = getStages(sweep)
+    cache = openCache(cache, stages, sweep)
+    metrics = mt.JobMetrics(stages) if metered else None
+    conn = u.db_connect()
+    for stage in stages:
+        stage.open(conn)
+
+    for i in range(0, len(records), CHUNK_SIZE):
+        annotateChunk(stages, records[i:i + CHUNK_SIZE], cache=cache,
+            metrics=metrics)
+
+    for stage in stages:
+        stage.close()
+    conn.close()
+
+    lookups = (0, 0)
+    if (cache is not None):
+        lookups = (cache.hits, cache.lookups)
+        cache.close(evict=False)
+    shard = metrics.shard() if (metrics is not None) else None
+    return n, records, [stage.counts for stage in stages], lookups, shard
+
+
+"""Annotates the shards of the input in a pool of processes and stitches
+   the records back together in their original order
+"""
+def runSharded(infile, outfile, shards, sweep=False, sep='\t', cache=None,
+    compress=False, logfile=None, metrics=None, format='vcf'):
+    lines = []
+    records = []
+    fh = openInput(infile, format)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            lines.append(line)
+        else:
+            lines.append(None)
+            records.append(vr.VcfRecord(line.split(sep)))
+    fh.close()
+
+    units = getShards(records, shards)
+    tasks = [(n, [records[i] for i in units[n]], sweep, cache,
+        metrics is not None) for n in range(len(units))]
+
+    stages = getStages(sweep)
+    cache = openCache(cache, stages, sweep)
+    pool = multiprocessing.Pool(shards)
+    for n, annotated, counts, lookups, shard in \
+        pool.imap_unordered(annotateShard, tasks):
+        for i, record in zip(units[n], annotated):
+            records[i] = record
+        for stage, shard_counts in zip(stages, counts):
+            for k in shard_counts:
+                stage.counts[k] = stage.counts[k] + shard_counts[k]
+        if (cache is not None):
+            cache.hits = cache.hits + lookups[0]
+            cache.lookups = cache.lookups + lookups[1]
+        if (metrics is not None):
+            metrics.merge(shard)
+    pool.close()
+    pool.join()
+
+    fh_out = bgzf.openOutput(outfile, compress)
+    r = 0
+    for line in lines:
+        if (line is None):
+            fh_out.write(records[r].line() + '\n')
+            r = r + 1
+        else:
+            fh_out.write(line + '\n')
+    fh_out.close()
+
+    writeCountLog(logfile or (infile + '.count.log'), stages, cache=cache)
+    if (cache is not None):
+        cache.close()
+
+
+"""Number of data lines of a VCF
+"""
+def countRecords(infile):
+    count = 0
+    fh = bgzf.openText(infile)
+    for line in fh:
+        if not line.startswith("#"):
+            count = count + 1
+    fh.close()
+    return count
+
+
+"""Runs the stages one after another through temporary files
+   (infile.1, infile.2, ...), one full pass per stage
+"""
+def runChained(infile, outfile, stages, compress=False, logfile=None,
+    metrics=None):
+    base = bgzf.stripSuffix(infile)
+    if (logfile is None):
+        logfile = base + '.count.log'
+    if (metrics is not None):
+        metrics.variants = countRecords(infile)
+    current = infile
+    tmpextout = 1
+    for stage in stages:
+        if (metrics is not None):
+            metrics.start(stage, size=os.path.getsize(current))
+        ann.annotateFile(stage, current, base + '.' + str(tmpextout), logfile)
+        if (metrics is not None):
+            metrics.stop(stage, size=os.path.getsize(base + '.' +
+                str(tmpextout)), variants=metrics.variants)
+        print(f"{stage.name} - done.")
+        current = base + '.' + str(tmpextout)
+        tmpextout = tmpextout + 1
 
     ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
+    for i in range(1, tmpextout - 1):
+        fu.delete(base + '.' + str(i))
+
+    if compress:
+        bgzf.compressFile(current, outfile)
+        fu.delete(current)
+    else:
+        os.rename(current, outfile)
+
+
+"""shards > 1 annotates chromosomes (or ranges of them) in that many
+   processes; the output is the same as a serial run
+   sweep=True joins the overlap tables by streaming them, for large
+   position-sorted inputs
+   cache, {'path', 'version', 'max_bytes'}, reuses the annotation of
+   records seen by earlier jobs (annotation_cache.py)
+   infile may be gzip/BGZF compressed (.vcf.gz, .vcf.bgz); compress=True
+   writes the result as BGZF, adding .gz to its name
+   format 'pileup' takes a samtools variant pileup, converted to VCF in
+   PILEUP_PROCESSES processes as it is read; the results are named as
+   for a .vcf input
+   measure=True writes per-stage metrics (metrics.py) to .metrics.json
+   next to the .count.log
+   source, an iterable of the input's lines, is read instead of infile and
+   sink, a file object, takes the annotated output instead of its file
+   (s3_stream.py); infile still names the results. Pipeline mode only
+   Returns the name of the annotated file
+"""
+def run(infile, format, pipeline=True, shards=1, sweep=False, cache=None,
+    compress=False, measure=False, source=None, sink=None):
+
+    print("Running . . .")
+
+    if ((source is not None) or (sink is not None)) and \
+        ((shards > 1) or not pipeline):
+        raise ValueError('streamed input and output need the pipeline mode')
+
+    base = bgzf.stripSuffix(infile)
+    if (format == 'pileup'):
+        base = os.path.splitext(base)[0] + '.vcf'
+    finalout = (base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress:
+        finalout = finalout + '.gz'
+    logfile = base + '.count.log'
+
+    stages = getStages(sweep)
+    metrics = mt.JobMetrics(stages) if measure else None
+
+    if (shards > 1):
+        mode = 'sharded'
+        runSharded(infile, finalout, shards, sweep=sweep, cache=cache,
+            compress=compress, logfile=logfile, metrics=metrics,
+            format=format)
+    elif pipeline:
+        mode = 'pipeline'
+        cache = openCache(cache, stages, sweep)
+        runPipeline(infile, finalout, stages, cache=cache, compress=compress,
+            logfile=logfile, metrics=metrics, format=format, source=source,
+            sink=sink)
+        if (cache is not None):
+            cache.close()
+    else:
+        mode = 'chained'
+        # The stages read files; the pileup is converted into one first
+        vcffile = infile
+        if (format == 'pileup'):
+            vcffile = base
+            fh_out = open(vcffile, 'w')
+            for line in openInput(infile, format):
+                fh_out.write(line + '\n')
+            fh_out.close()
+        runChained(vcffile, finalout, stages, compress=compress,
+            logfile=logfile, metrics=metrics)
+        if (vcffile != infile):
+            fu.delete(vcffile)
+
+    if (metrics is not None):
+        metrics.finish(source or infile, sink or finalout, mode=mode, shards=shards,
+            sweep=sweep, cache=(cache is not None), compress=compress)
+        metrics.write(base + '.metrics.json')
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    return finalout
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,246 @@
+# interval_index.py
+#
+# In-memory point-in-interval index over the reference tables, so that
+# overlap annotators query the database once per chromosome instead of
+# once per variant
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bisect
+import heapq
+import utils as u
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Loaded indexes, kept for the lifetime of the worker process
+_indexes = {}
+
+
+def _select(table, chrom, chromCol, startCol, endCol, columns):
+    if (columns is None):
+        columns = table + '.*'
+    sql = 'select ' + startCol + ', ' + endCol + ', ' + columns + \
+        ' from ' + table
+    if (chromCol is not None):
+        sql = sql + ' where ' + chromCol + '="' + str(chrom) + '"'
+    return sql
+
+
+"""Intervals of one chromosome, sorted by start
+   Intervals are grouped by length, each group holding lengths up to twice
+   those of the next shorter one; an interval of a group whose longest is
+   span can only contain pos if it starts in [pos - span, pos], so the
+   candidates looked at stay close to the hits even next to a few very
+   long intervals; hits are returned in table order
+"""
+class IntervalIndex(object):
+    def __init__(self, intervals):
+        order = sorted(range(len(intervals)), key=lambda i: intervals[i][0])
+        self.starts = [intervals[i][0] for i in order]
+        self.ends = [intervals[i][1] for i in order]
+        self.rows = [intervals[i][2] for i in order]
+        self.ordinals = order
+
+        groups = {}
+        for i in range(len(self.starts)):
+            length = max(self.ends[i] - self.starts[i], 0)
+            groups.setdefault(length.bit_length(), []).append(i)
+        # (span, starts, members) of each group, members sorted by start
+        self.groups = []
+        for key in sorted(groups):
+            members = groups[key]
+            span = max([max(self.ends[i] - self.starts[i], 0) for i in members])
+            self.groups.append((span, [self.starts[i] for i in members],
+                members))
+        self.arrays = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def hits(self, pos):
+        found = []
+        for span, starts, members in self.groups:
+            lo = bisect.bisect_left(starts, pos - span)
+            hi = bisect.bisect_right(starts, pos)
+            found.extend([i for i in members[lo:hi] if self.ends[i] >= pos])
+        found.sort(key=lambda i: self.ordinals[i])
+        return found
+
+    """All rows with start <= pos <= end, same as fetchall()
+    """
+    def query(self, pos):
+        return [self.rows[i] for i in self.hits(pos)]
+
+    """First row with start <= pos <= end or None, same as fetchone()
+    """
+    def first(self, pos):
+        found = self.hits(pos)
+        if (len(found) > 0):
+            return self.rows[found[0]]
+        return None
+
+    """Looks up a whole batch of positions of this chromosome
+       Returns (variants, rows): the position index and the row of every
+       hit, ordered by position index and then table order; with
+       first=True only the first hit of each position
+    """
+    def queryMany(self, positions, first=False):
+        if (np is None):
+            variants = []
+            rows = []
+            for v in range(len(positions)):
+                found = self.hits(positions[v])
+                if first:
+                    found = found[:1]
+                variants.extend([v] * len(found))
+                rows.extend([self.rows[i] for i in found])
+            return variants, rows
+
+        if (len(self.groups) == 0):
+            return [], []
+
+        if (self.arrays is None):
+            self.arrays = [np.array(self.ends, dtype=np.int64),
+                np.array(self.ordinals, dtype=np.int64),
+                [(span, np.array(starts, dtype=np.int64),
+                    np.array(members, dtype=np.int64))
+                    for span, starts, members in self.groups]]
+        ends, ordinals, groups = self.arrays
+
+        positions = np.asarray(positions, dtype=np.int64)
+        variants = []
+        rows = []
+        for span, starts, members in groups:
+            lo = np.searchsorted(starts, positions - span, side='left')
+            hi = np.searchsorted(starts, positions, side='right')
+            counts = hi - lo
+
+            # Expand every [lo, hi) candidate range and keep the real overlaps
+            found = np.repeat(np.arange(len(positions)), counts)
+            offsets = np.arange(counts.sum()) - \
+                np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = members[np.repeat(lo, counts) + offsets]
+            keep = ends[candidates] >= positions[found]
+            variants.append(found[keep])
+            rows.append(candidates[keep])
+        variants = np.concatenate(variants)
+        rows = np.concatenate(rows)
+
+        order = np.lexsort((ordinals[rows], variants))
+        variants = variants[order]
+        rows = rows[order]
+        if first:
+            variants, firsts = np.unique(variants, return_index=True)
+            rows = rows[firsts]
+        return variants.tolist(), [self.rows[i] for i in rows.tolist()]
+
+
+"""Returns the index of table on one chromosome, loading it on first use
+   startCol/endCol may be any SQL expression over the table columns;
+   rows hold the selected columns, i.e. the same tuples a per-variant
+   'select <columns> ... where start <= pos AND pos <= end' would return
+"""
+def getIndex(cursor, table, chrom=None, chromCol='chrom',
+    startCol='chromStart', endCol='chromEnd', columns=None):
+
+    key = (table, chrom, startCol, endCol, columns)
+    index = _indexes.get(key)
+    if (index is None):
+        cursor.execute(_select(table, chrom, chromCol, startCol, endCol,
+            columns) + ';')
+        intervals = []
+        for row in cursor.fetchall():
+            intervals.append((int(row[0]), int(row[1]), tuple(row[2:])))
+        index = IntervalIndex(intervals)
+        _indexes[key] = index
+
+    return index
+
+
+"""Sort-merge join of one chromosome of a table against increasing
+   positions: the table is streamed in start order on its own connection
+   and only the intervals overlapping the current position are kept, in
+   a heap ordered by end. Hits are returned in start order. A position
+   lower than the previous one restarts the stream.
+"""
+class SweepJoin(object):
+    def __init__(self, table, chrom=None, chromCol='chrom',
+        startCol='chromStart', endCol='chromEnd', columns=None):
+        self.sql = _select(table, chrom, chromCol, startCol, endCol,
+            columns) + ' order by ' + startCol + ';'
+        self.conn = None
+        self.restart()
+
+    def restart(self):
+        self.close()
+        self.conn = u.db_connect()
+        self.cursor = u.stream_cursor(self.conn)
+        self.cursor.execute(self.sql)
+        self.pending = self.cursor.fetchone()
+        self.active = []
+        self.seq = 0
+        self.last = None
+
+    def advance(self, pos):
+        if (self.last is not None) and (pos < self.last):
+            self.restart()
+        self.last = pos
+
+        while (self.pending is not None) and (int(self.pending[0]) <= pos):
+            row = self.pending
+            if (int(row[1]) >= pos):
+                heapq.heappush(self.active,
+                    (int(row[1]), self.seq, tuple(row[2:])))
+            self.seq = self.seq + 1
+            self.pending = self.cursor.fetchone()
+
+        while (len(self.active) > 0) and (self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        return [a[2] for a in sorted(self.active, key=lambda a: a[1])]
+
+    def query(self, pos):
+        return self.advance(pos)
+
+    def first(self, pos):
+        rows = self.advance(pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    """Same as IntervalIndex.queryMany(); positions are visited in sorted
+       order
+    """
+    def queryMany(self, positions, first=False):
+        found = {}
+        for v in sorted(range(len(positions)), key=lambda v: positions[v]):
+            rows = self.advance(positions[v])
+            found[v] = rows[:1] if first else rows
+
+        variants = []
+        rows = []
+        for v in range(len(positions)):
+            variants.extend([v] * len(found[v]))
+            rows.extend(found[v])
+        return variants, rows
+
+    def close(self):
+        if (self.conn is not None):
+            if (self.pending is None):
+                self.cursor.close()
+                self.conn.close()
+            else:
+                self.conn.discard()
+        self.conn = None
+
+
+"""Drops all loaded indexes, e.g. after the reference database is updated
+"""
+def clear():
+    _indexes.clear()
+
+### EOF
@@ -0,0 +1,187 @@
+# metrics.py
+#
+# Per-stage instrumentation of an annotation job: wall and CPU time,
+# queries and rows fetched from the reference database, bytes of records
+# read and written, and variants annotated by each stage, written as a
+# JSON sidecar next to the .count.log
+#
+# Queries and rows are counted by a backend wrapping the one in use
+# (utils.set_backend), so all connections of the process are counted,
+# including the streams of SweepJoin. Nothing is wrapped or timed unless
+# a job is run with metrics
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import utils as u
+
+# Reference database totals of this process, see MeteredBackend
+counters = {'queries': 0, 'rows': 0}
+
+# Per-stage metrics, added up across chunks and shards
+FIELDS = ['seconds', 'cpu_seconds', 'queries', 'rows', 'bytes_read',
+    'bytes_written', 'variants']
+
+
+"""Cursor counting its queries and the rows fetched through it
+"""
+class MeteredCursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, *args):
+        counters['queries'] = counters['queries'] + 1
+        return self._cursor.execute(sql, *args)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if (row is not None):
+            counters['rows'] = counters['rows'] + 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        counters['rows'] = counters['rows'] + len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        counters['rows'] = counters['rows'] + len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            counters['rows'] = counters['rows'] + 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class MeteredConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args):
+        return MeteredCursor(self._conn.cursor(*args))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+"""Backend handing out metered connections of another backend
+"""
+class MeteredBackend(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def connect(self):
+        return MeteredConnection(self.backend.connect())
+
+    def stream_cursor(self, conn):
+        if isinstance(conn, MeteredConnection):
+            conn = conn._conn
+        return MeteredCursor(self.backend.stream_cursor(conn))
+
+
+"""Counts the reference database use of this process from now on
+"""
+def install():
+    backend = u.get_backend()
+    if not isinstance(backend, MeteredBackend):
+        u.set_backend(MeteredBackend(backend))
+
+
+"""Bytes of the records as written out, one line each
+"""
+def recordBytes(chunk):
+    size = 0
+    for fields in chunk:
+        size = size + len(fields)
+        for f in fields:
+            size = size + len(f)
+    return size
+
+
+"""Size in bytes of a file, or of what went through a stream with a size
+   (s3_stream.S3Reader, S3Writer)
+"""
+def fileSize(f):
+    if hasattr(f, 'size'):
+        return f.size
+    return os.path.getsize(f)
+
+
+"""Metrics of the stages of one job (or of one shard of it)
+   start()/stop() bracket a stage's work on a chunk of records; stages are
+   told apart by their position in stages
+"""
+class JobMetrics(object):
+    def __init__(self, stages):
+        install()
+        self.positions = dict([(id(stages[i]), i) for i in range(len(stages))])
+        self.stages = [dict([('stage', stage.name), ('table', stage.table)] +
+            [(f, 0) for f in FIELDS]) for stage in stages]
+        self.job = {}
+        # Records of the job, including those no stage saw (cache hits)
+        self.variants = 0
+        self.running = None
+        self.begun = (time.time(), time.process_time())
+
+    def start(self, stage, chunk=None, size=None):
+        if (size is None):
+            size = recordBytes(chunk)
+        self.running = (time.time(), time.process_time(),
+            counters['queries'], counters['rows'], size)
+
+    """size: bytes written by the stage, measured from chunk by default
+    """
+    def stop(self, stage, chunk=None, size=None, variants=None):
+        wall, cpu, queries, rows, read = self.running
+        self.running = None
+        if (size is None):
+            size = recordBytes(chunk)
+        if (variants is None):
+            variants = len(chunk)
+
+        m = self.stages[self.positions[id(stage)]]
+        m['seconds'] = m['seconds'] + (time.time() - wall)
+        m['cpu_seconds'] = m['cpu_seconds'] + (time.process_time() - cpu)
+        m['queries'] = m['queries'] + (counters['queries'] - queries)
+        m['rows'] = m['rows'] + (counters['rows'] - rows)
+        m['bytes_read'] = m['bytes_read'] + read
+        m['bytes_written'] = m['bytes_written'] + size
+        m['variants'] = m['variants'] + variants
+
+    """Adds the metrics of a shard, as returned by shard()
+    """
+    def merge(self, shard):
+        for m, other in zip(self.stages, shard['stages']):
+            for f in FIELDS:
+                m[f] = m[f] + other[f]
+        self.variants = self.variants + shard['variants']
+
+    def shard(self):
+        return {'stages': self.stages, 'variants': self.variants}
+
+    """Job totals: wall and CPU time of the whole job (CPU of this process;
+       that of shard workers is in their stages), sizes of the input and
+       output files (or streams) and whatever else describes the run
+    """
+    def finish(self, infile, outfile, **job):
+        self.job = dict(job)
+        self.job['seconds'] = time.time() - self.begun[0]
+        self.job['cpu_seconds'] = time.process_time() - self.begun[1]
+        self.job['bytes_read'] = fileSize(infile)
+        self.job['bytes_written'] = fileSize(outfile)
+        self.job['variants'] = self.variants
+
+    def write(self, path):
+        with open(path, 'w') as fh:
+            json.dump({'job': self.job, 'stages': self.stages}, fh, indent=2)
+            fh.write('\n')
+
+### EOF
@@ -12,28 +12,26 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import datetime
+import collections
+import multiprocessing
 import file_utils as fu
+import bgzf
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
-ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
-                "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED_CHR = set(["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11",
+    "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "X", "Y",
+    "MT"])
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
-def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
-
-    for l in lst:
-        l = str(l)
-
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
+# Pileup lines converted per task of convert()
+CHUNK_SIZE = 20000
 
-    return (int(depth) - (match_sum + ast))
+"""Reads not matching the reference: the depth less the reference matches
+   ('.' forward, ',' reverse) and the deletion placeholders ('*')
+"""
+def count_alt(depth, bases):
+    return int(depth) - (bases.count('.') + bases.count(',') +
+        bases.count('*'))
 
 
 def vcfheader(pileup):
@@ -58,7 +56,7 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    if (alt not in HETERO):
         return alt
     else:
         alt_x = HETERO[alt]
@@ -83,7 +81,7 @@ def varpileup_line2vcf_line(pileupfields):
     alt_count = str(count_alt(depth, pileupfields[8]))
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if (alt in HETERO):
         GT = '0/1'
         alt = hetero2homo(ref,alt)
 
@@ -92,10 +90,74 @@ def varpileup_line2vcf_line(pileupfields):
         consqual + ':' + depth + ':' + alt_count
 
 
+"""VCF lines of the variant pileup lines, leaving out lines where ALT==REF
+   and chromosomes other than 1 - 22, X, Y and MT
+"""
+def convertLines(lines, chr_col=0, ref_col=2, alt_col=3, sep='\t'):
+    converted = []
+    for line in lines:
+        fields = line.strip().split(sep)
+        if ((fields[alt_col] != fields[ref_col]) and
+            (fields[chr_col].strip() in ACCEPTED_CHR)):
+            converted.append(varpileup_line2vcf_line(fields[0:9]))
+    return converted
+
+
+"""Streams the VCF lines (header included, no newlines) of a variant
+   pileup, plain or gzip compressed
+   processes > 1 converts chunks of lines in that many processes, a few
+   chunks ahead of the reader at most; lines come out in input order
+"""
+def convert(pileup, processes=1, chunksize=CHUNK_SIZE):
+    for line in vcfheader(bgzf.stripSuffix(pileup)).split('\n'):
+        yield line
+
+    fh = bgzf.openText(pileup)
+    pool = None
+    if (processes > 1):
+        pool = multiprocessing.Pool(processes)
+    pending = collections.deque()
+    try:
+        chunk = []
+        for line in fh:
+            chunk.append(line)
+            if (len(chunk) < chunksize):
+                continue
+            if (pool is None):
+                yield from convertLines(chunk)
+            else:
+                pending.append(pool.apply_async(convertLines, (chunk,)))
+                if (len(pending) >= 2 * processes):
+                    yield from pending.popleft().get()
+            chunk = []
+
+        while (len(pending) > 0):
+            yield from pending.popleft().get()
+        yield from convertLines(chunk)
+    finally:
+        if (pool is not None):
+            pool.terminate()
+            pool.join()
+        fh.close()
+
+
+"""Iterable of the VCF lines of a pileup, as read by the driver from a
+   VCF file
+"""
+class PileupReader(object):
+    def __init__(self, pileup, processes=1):
+        self.lines = convert(pileup, processes=processes)
+
+    def __iter__(self):
+        return self.lines
+
+    def close(self):
+        self.lines.close()
+
+
 def filter_pileup(pileup, outfile=None, chr_col=0, 
     ref_col=2, alt_col=3, sep='\t'):
     
-    fh = open(pileup, "r")
     if (outfile is None):
         outfile = pileup + '.vcf'
 
@@ -103,18 +165,13 @@ def filter_pileup(pileup, outfile=None, chr_col=0,
     fh_out = open(outfile, "w")
     fh_out.write(vcfheader(pileup) + '\n')
 
-
+    fh = open(pileup, "r")
     for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
-
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
-
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+        for vcf_line in convertLines([line], chr_col=chr_col,
+            ref_col=ref_col, alt_col=alt_col, sep=sep):
+            fh_out.write(vcf_line + '\n')
+    fh.close()
+    fh_out.close()
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
@@ -141,8 +198,7 @@ def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3,
                 ref = str(fields[ref_col])
                 alt = str(fields[alt_col])
 
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+                if ((alt != ref) and (chr.strip() in ACCEPTED_CHR)):
                     fh_out.write(str(line) + '\n')
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,62 @@
+# profiling.py
+#
+# Opt-in profiling of an annotation job: runs it under cProfile and
+# tracemalloc and writes the artifacts next to the job's other files
+#
+#   <base>.prof         cProfile stats, for pstats or snakeviz
+#   <base>.prof.txt     the same, as text, top functions by cumulative time
+#   <base>.alloc.txt    top allocation sites still held at the end of the
+#                       job, and the peak traced memory
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import pstats
+import cProfile
+import tracemalloc
+
+# Functions / allocation sites listed in the text reports
+TOP = 40
+
+# Stack frames kept per traced allocation
+FRAMES = 1
+
+
+"""Calls function(*args, **kwargs) under cProfile and tracemalloc and
+   writes the artifacts named base + suffix
+   Returns (result of the call, names of the files written)
+"""
+def profileCall(base, function, *args, **kwargs):
+    tracemalloc.start(FRAMES)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    profile.dump_stats(base + '.prof')
+
+    text = io.StringIO()
+    stats = pstats.Stats(profile, stream=text)
+    stats.sort_stats('cumulative').print_stats(TOP)
+    with open(base + '.prof.txt', 'w') as fh:
+        fh.write(text.getvalue())
+
+    # Allocations made by the tracer itself are left out
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+    with open(base + '.alloc.txt', 'w') as fh:
+        fh.write(f"Peak traced memory: {peak / 1024.0:.1f} KiB\n")
+        fh.write(f"Traced at the end: {current / 1024.0:.1f} KiB\n\n")
+        for stat in snapshot.statistics('lineno')[:TOP]:
+            fh.write(str(stat) + '\n')
+
+    return result, [base + '.prof', base + '.prof.txt', base + '.alloc.txt']
+
+### EOF
@@ -7,7 +7,8 @@ from subprocess import Popen, PIPE, DEVNULL
 from boto3.dynamodb.conditions import Key, Attr
 from configparser import SafeConfigParser
 from datetime import datetime
-import os, subprocess, logging, sys, time, driver, boto3 
+import os, subprocess, logging, sys, time, driver, tabix, profiling, boto3 
+import s3_stream
 
 class Timer(object):
     def __init__(self, verbose=True):
@@ -22,104 +23,205 @@ class Timer(object):
         if self.verbose:
             print(f'Approximate runtime: {self.secs:.2f} seconds')
 
+# Config and AWS clients, kept for the life of the process: a warm
+# worker (annotator.WorkerPool) runs many jobs without paying for them again
+_config = None
+_clients = {}
+
+def getConfig():
+    global _config
+    if (_config is None):
+        '''
+        Reference:
+        https://docs.python.org/3/library/configparser.html
+        '''
+        config = SafeConfigParser(os.environ)
+        config.read('ann_config.ini')
+        _config = config
+    return _config
+
+"""boto3 client, or resource for 'dynamodb', for the configured region
+"""
+def getClient(service):
+    if service not in _clients:
+        AwsRegionName = getConfig().get('AWS', 'AwsRegionName')
+        if (service == 'dynamodb'):
+            _clients[service] = boto3.resource(service,
+                region_name=AwsRegionName)
+        else:
+            _clients[service] = boto3.client(service,
+                region_name=AwsRegionName)
+    return _clients[service]
+
+"""Annotates input_file, the local copy of the S3 object key, uploads the
+   results, removes the local files, marks the job COMPLETED and publishes
+   its notification. With [Streaming] Enabled the input is read from S3
+   instead where it can be, see s3_stream.py
+"""
+def runJob(input_file, key, profile=False):
+    config = getConfig()
+    InputBucket = config.get('Bucket', 'InputBucket')
+    ResultBucket = config.get('Bucket', 'ResultBucket')
+    DatabaseName = config.get('Dynamodb', 'DatabaseName')
+    ResultFolder = config.get('Path', 'ResultFolder')
+    annot_vcf = config.get('Extension', 'annot_vcf')
+    count_log = config.get('Extension', 'count_log')
+    metrics_json = config.get('Extension', 'metrics_json')
+    ARN = config.get('SNS', 'ARN')
+    Shards = int(config.get('Pipeline', 'Shards'))
+    SweepJoin = config.getboolean('Pipeline', 'SweepJoin')
+    CompressOutput = config.getboolean('Pipeline', 'CompressOutput')
+    Metrics = config.getboolean('Pipeline', 'Metrics')
+    Cache = None
+    if config.getboolean('Cache', 'Enabled'):
+        Cache = {'path': ResultFolder + '/' + config.get('Cache', 'File'),
+            'version': config.get('Cache', 'ReferenceVersion'),
+            'max_bytes': int(config.get('Cache', 'MaxSizeMB')) * 1024 * 1024}
+
+    # Profiling is switched on for all jobs in the config, or for
+    # one job by its request
+    Profile = config.getboolean('Profiling', 'Enabled') or profile
+
+    # VCF, or a samtools variant pileup converted on the fly
+    Format = driver.inputFormat(input_file)
+    options = {'shards': Shards, 'sweep': SweepJoin, 'cache': Cache,
+        'compress': CompressOutput, 'measure': Metrics}
+    if CompressOutput:
+        annot_vcf = annot_vcf + '.gz'
+    key_front = key.split('.')[0]
+    filename = key.split('/')[-1]
+    name = filename.split('.')[0]
+    id_fn = filename.split('~')
+    job_id = id_fn[0]
+
+    # Parameters
+    annot_file = ResultFolder + '/' + name + annot_vcf
+    log_file = ResultFolder + '/' + name + count_log
+    annot_key = key_front + annot_vcf
+    log_key = key_front + count_log
+    metrics_file = ResultFolder + '/' + name + metrics_json
+    metrics_key = key_front + metrics_json
+
+    # A VCF annotated in one pass is read from S3 and its result sent
+    # back while the job runs; other jobs work on a local copy, which
+    # annotator.py leaves to the job when it streams
+    s3_client = getClient('s3')
+    Stream = config.getboolean('Streaming', 'Enabled') and \
+        (Shards == 1) and (Format == 'vcf')
+    if not Stream and not os.path.exists(input_file):
+        '''
+        Reference:
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
+        '''
+        s3_client.download_file(InputBucket, key, input_file)
+    if Stream:
+        # The tabix index is built from a local copy of the result
+        options['source'] = s3_stream.S3Reader(s3_client, InputBucket, key)
+        options['sink'] = s3_stream.S3Writer(s3_client, ResultBucket,
+            annot_key, copy=annot_file if CompressOutput else None)
+
+    profile_files = []
+    try:
+        if Profile:
+            profile_files = profiling.profileCall(input_file,
+                driver.run, input_file, Format, **options)[1]
+        else:
+            driver.run(input_file, Format, **options)
+    except Exception:
+        if Stream:
+            options['sink'].abort()
+        raise
+    finally:
+        if Stream:
+            options['source'].close()
+
+    # Positional index next to a compressed result, for reading
+    # regions with ranged GETs; skipped if the input is not sorted
+    index_file = None
+    if CompressOutput:
+        index_file = tabix.build(annot_file)
+    
+    # Upload the result file and the log file 
+    '''
+    https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
+    '''
+    try:
+        if not Stream:
+            s3_client.upload_file(annot_file, ResultBucket, annot_key)
+        s3_client.upload_file(log_file, ResultBucket, log_key)
+        if Metrics:
+            s3_client.upload_file(metrics_file, ResultBucket,
+                metrics_key)
+        if (index_file is not None):
+            s3_client.upload_file(index_file, ResultBucket,
+                annot_key + '.tbi')
+        # Profiling artifacts under the job's key prefix
+        for profile_file in profile_files:
+            s3_client.upload_file(profile_file, ResultBucket, key_front +
+                profile_file[len(ResultFolder + '/' + name):])
+    except ClientError as e:
+        logging.error(e)
+        print(e)
+
+    # Clean up local job files
+    if os.path.exists(input_file):
+        os.remove(input_file)
+    if os.path.exists(annot_file):
+        os.remove(annot_file)
+    os.remove(log_file)
+    if Metrics:
+        os.remove(metrics_file)
+    if (index_file is not None):
+        os.remove(index_file)
+    for profile_file in profile_files:
+        os.remove(profile_file)
+    # Update Database item
+    '''
+    Reference:
+    https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+    '''
+    ct = int(time.time())
+    complete_time = str(datetime.fromtimestamp(ct))
+    table = getClient('dynamodb').Table(DatabaseName)
+    try:
+        response = table.update_item(
+                Key={'job_id':job_id},
+                UpdateExpression="SET s3_results_bucket=:val1, s3_key_result_file=:val2, \
+                        s3_key_log_file=:val3, complete_time=:val4, ct=:val5, \
+                        job_status=:val6, upgrade_premium=:val7, archive_status=:val8",
+                ExpressionAttributeValues={
+                    ':val1':ResultBucket,
+                    ':val2':annot_key,
+                    ':val3':log_key,
+                    ':val4':complete_time,
+                    ':val5':ct,
+                    ':val6':'COMPLETED',
+                    ':val7':False,
+                    ':val8':False
+                    },
+                ReturnValues='UPDATED_NEW'
+                ) 
+    except ClientError as e:
+        logging.error(e)
+        print(e)
+
+    # Publish notification to jing3_job_results
+    '''
+    Reference:
+    https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
+    '''
+    client = getClient('sns')
+    response = client.publish(
+            TopicArn = ARN,
+            Message = job_id
+            )
+
 if __name__ == '__main__':
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
         with Timer():
-            '''
-            Reference:
-            https://docs.python.org/3/library/configparser.html
-            '''
-            config = SafeConfigParser(os.environ)
-            config.read('ann_config.ini')
-            AwsRegionName = config.get('AWS', 'AwsRegionName')
-            ResultBucket = config.get('Bucket', 'ResultBucket')
-            DatabaseName = config.get('Dynamodb', 'DatabaseName')
-            ResultFolder = config.get('Path', 'ResultFolder')
-            annot_vcf = config.get('Extension', 'annot_vcf')
-            count_log = config.get('Extension', 'count_log')
-            ARN = config.get('SNS', 'ARN')
-
-            driver.run(sys.argv[1], 'vcf')
-            # Upload the result file and the log file 
-            key = sys.argv[2]
-            key_front = key.split('.')[0]
-            filename = key.split('/')[-1]
-            name = filename.split('.')[0]
-            id_fn = filename.split('~')
-            job_id = id_fn[0]
-
-            # Parameters
-            annot_file = ResultFolder + '/' + name + annot_vcf
-            log_file = ResultFolder + '/' + name + count_log
-            annot_key = key_front + annot_vcf
-            log_key = key_front + count_log
-            
-            # Upload 
-            '''
-            https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
-            '''
-            s3_client = boto3.client('s3')
-            try:
-                s3_client.upload_file(annot_file, ResultBucket, annot_key)
-                s3_client.upload_file(log_file, ResultBucket, log_key)
-            except ClientError as e:
-                logging.error(e)
-                print(e)
-
-            # Clean up local job files
-            input_file = ResultFolder + '/' + filename 
-            os.remove(input_file)
-            os.remove(annot_file)
-            os.remove(log_file)
-            # Update Database item
-            '''
-            Reference:
-            https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-            '''
-            ct = int(time.time())
-            complete_time = str(datetime.fromtimestamp(ct))
-            dynamodb = boto3.resource('dynamodb', region_name=AwsRegionName)
-            table = dynamodb.Table(DatabaseName)
-            try:
-                response = table.update_item(
-                        Key={'job_id':job_id},
-                        UpdateExpression="SET s3_results_bucket=:val1, s3_key_result_file=:val2, \
-                                s3_key_log_file=:val3, complete_time=:val4, ct=:val5, \
-                                job_status=:val6, upgrade_premium=:val7, archive_status=:val8",
-                        ExpressionAttributeValues={
-                            ':val1':ResultBucket,
-                            ':val2':annot_key,
-                            ':val3':log_key,
-                            ':val4':complete_time,
-                            ':val5':ct,
-                            ':val6':'COMPLETED',
-                            ':val7':False,
-                            ':val8':False
-                            },
-                        ReturnValues='UPDATED_NEW'
-                        ) 
-            except ClientError as e:
-                logging.error(e)
-                print(e)
-
-            # Publish notification to jing3_job_results
-            '''
-            Reference:
-            https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
-            '''
-            client = boto3.client('sns', region_name=AwsRegionName)
-            response = client.publish(
-                    TopicArn = ARN,
-                    Message = job_id
-                    )
-
+            runJob(sys.argv[1], sys.argv[2], '--profile' in sys.argv[3:])
     else:
         print('A valid .vcf file must be provided as input to this program.')
 
 ### EOF
-
-
-
-
-
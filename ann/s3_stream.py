@@ -0,0 +1,218 @@
+# s3_stream.py
+#
+# Streaming job I/O. The input is read from S3 while it downloads and the
+# annotated output is sent to S3 in parts while it is written, so a job's
+# transfers overlap its annotation instead of preceding and following it
+#
+#   S3Reader    lines of an S3 object, gunzipped if it is gzip/BGZF; a
+#               thread keeps up to READ_AHEAD blocks downloaded ahead
+#   S3Writer    file object for text or bytes, uploaded as a multipart
+#               upload with up to PARTS_IN_FLIGHT parts being sent
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import zlib
+import queue
+import codecs
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes read from the input at a time
+READ_SIZE = int(os.environ['ANN_S3_READ_SIZE']) if \
+    ('ANN_S3_READ_SIZE' in os.environ) else 8 * 1024 * 1024
+
+# Blocks of the input downloaded ahead of the parser
+READ_AHEAD = 4
+
+# Bytes per part of the output; S3 takes parts of 5 MB or more, but the last
+PART_SIZE = int(os.environ['ANN_S3_PART_SIZE']) if \
+    ('ANN_S3_PART_SIZE' in os.environ) else 8 * 1024 * 1024
+
+# Parts of the output being uploaded while more is written
+PARTS_IN_FLIGHT = 4
+
+
+"""Iterable of the text lines of an S3 object, as bgzf.openText gives
+   those of a file; size counts the bytes downloaded so far
+"""
+class S3Reader(object):
+    def __init__(self, client, bucket, key, blocksize=READ_SIZE):
+        self.size = 0
+        self.closed = False
+        self.blocks = queue.Queue(READ_AHEAD)
+        '''
+        Reference:
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.get_object
+        '''
+        self.body = client.get_object(Bucket=bucket, Key=key)['Body']
+        self.thread = threading.Thread(target=self._fetch, args=(blocksize,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self.blocks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch(self, blocksize):
+        try:
+            while True:
+                data = self.body.read(blocksize)
+                if not self._put(data) or (len(data) == 0):
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _blocks(self):
+        while True:
+            data = self.blocks.get()
+            if isinstance(data, Exception):
+                raise data
+            if (len(data) == 0):
+                return
+            self.size = self.size + len(data)
+            yield data
+
+    """Decompressed data; BGZF is a series of gzip members, a new
+       decompressor is started at the end of each
+    """
+    def _inflate(self, blocks):
+        inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for data in blocks:
+            while (len(data) > 0):
+                yield inflate.decompress(data)
+                if not inflate.eof:
+                    break
+                data = inflate.unused_data
+                inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def __iter__(self):
+        blocks = self._blocks()
+        first = next(blocks, b'')
+        data = itertools.chain([first], blocks)
+        if first.startswith(b'\x1f\x8b'):
+            data = self._inflate(data)
+
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        tail = ''
+        for chunk in data:
+            lines = (tail + decoder.decode(chunk)).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        tail = tail + decoder.decode(b'', True)
+        if (len(tail) > 0):
+            yield tail
+
+    def close(self):
+        self.closed = True
+        self.body.close()
+
+
+"""Writable file object whose content becomes the S3 object key when it
+   is closed; small outputs are sent with one PUT. copy names a local file
+   that receives the same bytes (for an index built after the job)
+   size and tell() give the bytes written so far
+"""
+class S3Writer(object):
+    def __init__(self, client, bucket, key, partsize=PART_SIZE, copy=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.partsize = partsize
+        self.size = 0
+        self.buffer = bytearray()
+        self.copy = open(copy, 'wb') if (copy is not None) else None
+        self.upload = None
+        self.parts = []
+        self.executor = None
+        self.closed = False
+
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        self.buffer.extend(text)
+        self.size = self.size + len(text)
+        if (self.copy is not None):
+            self.copy.write(text)
+        while (len(self.buffer) >= self.partsize):
+            self._send(bytes(self.buffer[:self.partsize]))
+            del self.buffer[:self.partsize]
+
+    def tell(self):
+        return self.size
+
+    """Starts uploading the next part, once fewer than PARTS_IN_FLIGHT
+       are on their way
+    """
+    def _send(self, data):
+        '''
+        Reference:
+        https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_part
+        '''
+        if (self.upload is None):
+            self.upload = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+            self.executor = ThreadPoolExecutor(PARTS_IN_FLIGHT)
+        sending = [part for part in self.parts if not part[1].done()]
+        if (len(sending) >= PARTS_IN_FLIGHT):
+            sending[0][1].result()
+        number = len(self.parts) + 1
+        self.parts.append((number, self.executor.submit(
+            self.client.upload_part, Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload, PartNumber=number, Body=data)))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if (self.upload is None):
+                self.client.put_object(Bucket=self.bucket, Key=self.key,
+                    Body=bytes(self.buffer))
+            else:
+                if (len(self.buffer) > 0):
+                    self._send(bytes(self.buffer))
+                parts = [{'ETag': part.result()['ETag'], 'PartNumber': number}
+                    for number, part in self.parts]
+                self.client.complete_multipart_upload(Bucket=self.bucket,
+                    Key=self.key, UploadId=self.upload,
+                    MultipartUpload={'Parts': parts})
+                self.executor.shutdown()
+        except Exception:
+            self.abort()
+            raise
+        self.buffer = bytearray()
+        self.closed = True
+        if (self.copy is not None):
+            self.copy.close()
+
+    """Drops what was uploaded of an output that will not be completed
+    """
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if (self.copy is not None):
+            self.copy.close()
+        if (self.upload is not None):
+            self.executor.shutdown(cancel_futures=True)
+            self.client.abort_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if (args[0] is None):
+            self.close()
+        else:
+            self.abort()
+
+### EOF
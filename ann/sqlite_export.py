@@ -0,0 +1,123 @@
+# sqlite_export.py
+#
+# Exports the reference database (the annotator schema on RDS) into a
+# SQLite file that utils.SqliteBackend serves read-only, so annotator
+# instances can answer lookups from a local replica:
+#
+#   python sqlite_export.py reference.sqlite
+#   ANN_DB_BACKEND=sqlite ANN_DB_SQLITE_PATH=reference.sqlite python run.py ...
+#
+# Columns are created without declared types, so values keep the types
+# pymysql returns (ints, strings, bytes for BLOBs) and compare the same
+# way in the annotators' queries. Every table gets an index over its
+# chromosome, start and end columns.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import decimal
+import datetime
+import sqlite3
+import utils as u
+
+# Rows copied per batch
+BATCH_SIZE = 10000
+
+# Position columns, by preference, as named across the reference tables
+CHROM_COLUMNS = ['chrom', 'chromosome', 'CHR']
+START_COLUMNS = ['chromStart', 'txStart', 'start', 'POS']
+END_COLUMNS = ['chromEnd', 'txEnd', 'end']
+
+
+def _value(value):
+    if isinstance(value, (decimal.Decimal, datetime.date, datetime.time,
+        datetime.timedelta)):
+        return str(value)
+    return value
+
+
+def _first(columns, candidates):
+    for c in candidates:
+        if (c in columns):
+            return c
+    return None
+
+
+"""(chrom, start, end) columns of a table, as far as it has them
+"""
+def positionColumns(columns):
+    return [c for c in [_first(columns, CHROM_COLUMNS),
+        _first(columns, START_COLUMNS), _first(columns, END_COLUMNS)]
+        if (c is not None)]
+
+
+"""Copies one table of the source connection into out
+"""
+def exportTable(conn, out, table, backend):
+    cursor = backend.stream_cursor(conn)
+    cursor.execute('select * from ' + table + ';')
+    columns = [d[0] for d in cursor.description]
+
+    out.execute('drop table if exists "' + table + '";')
+    out.execute('create table "' + table + '" (' +
+        ', '.join(['"' + c + '"' for c in columns]) + ');')
+    insert = 'insert into "' + table + '" values (' + \
+        ','.join(['?'] * len(columns)) + ');'
+
+    count = 0
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        out.executemany(insert, [[_value(v) for v in row] for row in rows])
+        count = count + len(rows)
+    cursor.close()
+
+    position = positionColumns(columns)
+    if (len(position) > 0):
+        out.execute('create index "' + table + '_position" on "' + table +
+            '" (' + ', '.join(['"' + c + '"' for c in position]) + ');')
+    out.commit()
+    return count
+
+
+"""Exports tables (all tables of the source by default) into path
+   The file is written under a temporary name and renamed when complete
+"""
+def export(path, tables=None, backend=None):
+    if (backend is None):
+        backend = u.MySqlBackend()
+    conn = backend.connect()
+    if (tables is None):
+        cursor = conn.cursor()
+        cursor.execute('show tables;')
+        tables = sorted([str(row[0]) for row in cursor.fetchall()])
+        cursor.close()
+
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    out = sqlite3.connect(tmp)
+    out.execute('pragma journal_mode = off;')
+    out.execute('pragma synchronous = off;')
+
+    for table in tables:
+        count = exportTable(conn, out, table, backend)
+        print(f"{table}: {str(count)} rows - done.")
+
+    out.execute('analyze;')
+    out.commit()
+    out.close()
+    conn.close()
+    os.rename(tmp, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        export(sys.argv[1], tables=sys.argv[2:] or None)
+    else:
+        print('usage: python sqlite_export.py <sqlite file> [table ...]')
+
+### EOF
@@ -0,0 +1,271 @@
+# tabix.py
+#
+# Tabix (.tbi) index of a coordinate-sorted BGZF VCF, and region queries
+# against it: a region resolves to the chunks of the file, as BGZF virtual
+# offsets, holding its records, and from those to the byte ranges to
+# fetch, e.g. with S3 ranged GETs, instead of the whole file
+#
+# Index layout as in the SAMtools tabix specification: UCSC binning over
+# 5 levels plus a linear index of 16 kb windows, per sequence
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import struct
+import bgzf
+
+MAGIC = b'TBI\x01'
+
+# Preset for VCF: format, sequence/begin/end columns, meta character, skip
+VCF_PRESET = (2, 1, 2, 0, ord('#'), 0)
+
+# Linear index window
+LINEAR_SHIFT = 14
+
+# Binning levels: (shift, first bin of the level)
+LEVELS = [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]
+
+
+"""Smallest bin holding [beg, end), 0-based
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    for shift, first in reversed(LEVELS):
+        if ((beg >> shift) == (end >> shift)):
+            return first + (beg >> shift)
+    return 0
+
+
+"""All bins that may hold records overlapping [beg, end), 0-based
+"""
+def reg2bins(beg, end):
+    end = end - 1
+    bins = [0]
+    for shift, first in LEVELS:
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+"""Builds the index of the coordinate-sorted BGZF VCF path and writes it
+   to path + '.tbi'; returns that name, or None if the records are not
+   sorted (grouped by chromosome, positions ascending)
+"""
+def build(path):
+    names = []
+    refs = {}
+    held = None
+
+    def add(line, start, end):
+        text = line.decode('utf-8')
+        if text.startswith('#') or (len(text.strip()) == 0):
+            return True
+        fields = text.split('\t')
+        chrom = fields[0]
+        beg = int(fields[1]) - 1
+        span = len(fields[3]) if (len(fields) > 3) else 1
+        stop = beg + max(span, 1)
+
+        if (chrom not in refs):
+            names.append(chrom)
+            refs[chrom] = ({}, [], [-1])
+        elif (chrom != names[-1]) or (beg < refs[chrom][2][0]):
+            return False
+        bins, linear, last = refs[chrom]
+        last[0] = beg
+
+        binChunks = bins.setdefault(reg2bin(beg, stop), [])
+        if (len(binChunks) > 0) and (binChunks[-1][1] == start):
+            binChunks[-1][1] = end
+        else:
+            binChunks.append([start, end])
+
+        for w in range(beg >> LINEAR_SHIFT, ((stop - 1) >> LINEAR_SHIFT) + 1):
+            while (len(linear) <= w):
+                linear.append(None)
+            if (linear[w] is None):
+                linear[w] = start
+        return True
+
+    # A record's end offset is the start of the next one
+    with open(path, 'rb') as fh:
+        pending = b''
+        start = None
+        last = None
+        for offset, data in bgzf.iterBlocks(fh):
+            if (held is not None):
+                if not add(held[0], held[1], (offset << 16)):
+                    return None
+                held = None
+            i = 0
+            while (i < len(data)):
+                if (start is None):
+                    start = (offset << 16) | i
+                j = data.find(b'\n', i)
+                if (j < 0):
+                    pending = pending + data[i:]
+                    break
+                line = pending + data[i:j]
+                pending = b''
+                i = j + 1
+                if (i == len(data)):
+                    held = (line, start)
+                elif not add(line, start, (offset << 16) | i):
+                    return None
+                start = None
+            last = offset
+        if (held is not None) or (len(pending) > 0):
+            end = (last << 16) if (last is not None) else 0
+            if (held is not None) and not add(held[0], held[1], end):
+                return None
+            if (len(pending) > 0) and not add(pending, start, end):
+                return None
+
+    out = io.BytesIO()
+    text = b''.join([n.encode('utf-8') + b'\0' for n in names])
+    out.write(MAGIC + struct.pack('<i', len(names)))
+    out.write(struct.pack('<6i', *VCF_PRESET))
+    out.write(struct.pack('<i', len(text)) + text)
+    for chrom in names:
+        bins, linear, last = refs[chrom]
+        out.write(struct.pack('<i', len(bins)))
+        for b in sorted(bins):
+            out.write(struct.pack('<Ii', b, len(bins[b])))
+            for chunk in bins[b]:
+                out.write(struct.pack('<QQ', chunk[0], chunk[1]))
+        # Empty windows point at the previous record, as htslib does
+        previous = 0
+        for w in range(len(linear)):
+            if (linear[w] is None):
+                linear[w] = previous
+            previous = linear[w]
+        out.write(struct.pack('<i', len(linear)))
+        out.write(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+
+    with bgzf.BgzfWriter(path + '.tbi') as fh_out:
+        fh_out.write(out.getvalue())
+    return path + '.tbi'
+
+
+"""Parses a .tbi, given as bytes or a file name
+   Returns {sequence: (bins {bin: [(start, end), ...]}, linear index)}
+"""
+def readIndex(tbi):
+    if isinstance(tbi, str):
+        with open(tbi, 'rb') as fh:
+            tbi = fh.read()
+    data = gzip.decompress(tbi)
+    if (data[:4] != MAGIC):
+        raise IOError('not a tabix index')
+
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    l_nm = struct.unpack_from('<i', data, 32)[0]
+    names = data[36:36 + l_nm].split(b'\0')[:n_ref]
+    pos = 36 + l_nm
+
+    index = {}
+    for name in names:
+        n_bin = struct.unpack_from('<i', data, pos)[0]
+        pos = pos + 4
+        bins = {}
+        for i in range(n_bin):
+            b, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos = pos + 8
+            chunks = struct.unpack_from('<' + str(2 * n_chunk) + 'Q', data, pos)
+            pos = pos + 16 * n_chunk
+            bins[b] = list(zip(chunks[0::2], chunks[1::2]))
+        n_intv = struct.unpack_from('<i', data, pos)[0]
+        pos = pos + 4
+        linear = list(struct.unpack_from('<' + str(n_intv) + 'Q', data, pos))
+        pos = pos + 8 * n_intv
+        index[name.decode('utf-8')] = (bins, linear)
+    return index
+
+
+"""Chunks [(start, end), ...] of virtual offsets holding the records that
+   may overlap chrom:beg-end (1-based, inclusive), merged and in order
+"""
+def chunks(index, chrom, beg, end):
+    if (chrom not in index):
+        return []
+    bins, linear = index[chrom]
+    beg = max(beg - 1, 0)
+
+    minimum = 0
+    w = beg >> LINEAR_SHIFT
+    if (len(linear) > 0):
+        minimum = linear[min(w, len(linear) - 1)]
+
+    found = []
+    for b in reg2bins(beg, end):
+        for chunk in bins.get(b, []):
+            if (chunk[1] > minimum):
+                found.append(chunk)
+    found.sort()
+
+    merged = []
+    for start, stop in found:
+        if (len(merged) > 0) and (start <= merged[-1][1]):
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return [(start, stop) for start, stop in merged]
+
+
+"""Inclusive byte ranges of the compressed file to fetch for chunks
+   The block a chunk ends in is read whole, up to the 64 KiB block limit
+"""
+def byteRanges(chunks):
+    ranges = []
+    for start, stop in chunks:
+        first = start >> 16
+        if (stop & 0xffff):
+            last = (stop >> 16) + 0xffff
+        else:
+            last = (stop >> 16) - 1
+        if (len(ranges) > 0) and (first <= ranges[-1][1] + 1):
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+
+"""Records (lines) of chrom:beg-end (1-based, inclusive)
+   fetch(first, last) returns the bytes first..last of the BGZF file, e.g.
+   s3Range(); reads past the end of the file return what there is
+"""
+def fetchRegion(fetch, index, chrom, beg, end):
+    records = []
+    for start, stop in chunks(index, chrom, beg, end):
+        first = start >> 16
+        last = byteRanges([(start, stop)])[0][1]
+        text = []
+        blocks = bgzf.iterBlocks(io.BytesIO(fetch(first, last)), first)
+        for offset, data in blocks:
+            lo = (start & 0xffff) if (offset == first) else 0
+            if (offset == (stop >> 16)):
+                text.append(data[lo:stop & 0xffff])
+                break
+            text.append(data[lo:])
+
+        for line in b''.join(text).decode('utf-8').split('\n'):
+            fields = line.split('\t')
+            if (len(fields) < 4) or (fields[0] != chrom):
+                continue
+            pos = int(fields[1])
+            if (pos <= end) and (pos + max(len(fields[3]), 1) - 1 >= beg):
+                records.append(line)
+    return records
+
+
+"""fetch() for fetchRegion() reading an S3 object with ranged GETs
+"""
+def s3Range(s3_client, bucket, key):
+    def fetch(first, last):
+        response = s3_client.get_object(Bucket=bucket, Key=key,
+            Range='bytes=' + str(first) + '-' + str(last))
+        return response['Body'].read()
+    return fetch
+
+### EOF
@@ -0,0 +1,93 @@
+# transcripts.py
+#
+# Transcript cache for the gene structure annotation: refGene rows parsed
+# once per chromosome into integer coordinates and exon arrays, indexed by
+# their promoter-extended span
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bisect
+import interval_index as ii
+
+# Loaded transcript indexes, kept for the lifetime of the worker process
+_indexes = {}
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
+"""One refGene row with its coordinates as ints
+   Exon arrays hold the first exonCount entries of exonStarts/exonEnds
+"""
+class Transcript(object):
+    __slots__ = ('row', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+        'exonCount', 'exonStarts', 'exonEnds', 'maxEnds')
+
+    def __init__(self, row):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = [int(x) for x in
+            _text(row[9]).split(',')[:self.exonCount]]
+        self.exonEnds = [int(x) for x in
+            _text(row[10]).split(',')[:self.exonCount]]
+
+        # Running maximum of the ends, for bisecting; None if the exons are
+        # not in start order and have to be scanned
+        self.maxEnds = None
+        if (self.exonStarts == sorted(self.exonStarts)):
+            self.maxEnds = []
+            maxEnd = None
+            for end in self.exonEnds:
+                if (maxEnd is None) or (end > maxEnd):
+                    maxEnd = end
+                self.maxEnds.append(maxEnd)
+
+    """Indexes e of the exons with exonStarts[e] <= pos <= exonEnds[e],
+       ascending
+    """
+    def exons(self, pos):
+        if (self.maxEnds is None):
+            lo = 0
+            hi = len(self.exonStarts)
+        else:
+            lo = bisect.bisect_left(self.maxEnds, pos)
+            hi = bisect.bisect_right(self.exonStarts, pos)
+        return [e for e in range(lo, hi)
+            if (self.exonStarts[e] <= pos) and (pos <= self.exonEnds[e])]
+
+
+"""Returns the transcripts of table on chrom whose span, widened by
+   promoter_offset on both sides, contains a position; rows are the
+   Transcript objects, in table order
+"""
+def getIndex(cursor, table, chrom, promoter_offset=500):
+    key = (table, chrom, promoter_offset)
+    index = _indexes.get(key)
+    if (index is None):
+        sql = 'select * from ' + table + ' where chrom="' + str(chrom) + '";'
+        cursor.execute(sql)
+        intervals = []
+        for row in cursor.fetchall():
+            t = Transcript(tuple(row))
+            intervals.append((t.txStart - int(promoter_offset),
+                t.txEnd + int(promoter_offset), t))
+        index = ii.IntervalIndex(intervals)
+        _indexes[key] = index
+    return index
+
+
+"""Drops all loaded transcripts
+"""
+def clear():
+    _indexes.clear()
+
+### EOF
@@ -13,17 +13,52 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
-import pymysql
+import time
+import sqlite3
+import threading
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+# Reference database backend: 'mysql' (RDS) or 'sqlite', a local read-only
+# replica at DB_SQLITE_PATH built by sqlite_export.py
+DB_BACKEND = os.environ['ANN_DB_BACKEND'] if \
+    ('ANN_DB_BACKEND' in os.environ) else 'mysql'
+
+DB_SQLITE_PATH = os.environ['ANN_DB_SQLITE_PATH'] if \
+    ('ANN_DB_SQLITE_PATH' in os.environ) else 'reference.sqlite'
+
+# Seconds the RDS secret is reused before it is fetched again
+SECRET_TTL = int(os.environ['ANN_DB_SECRET_TTL']) if \
+    ('ANN_DB_SECRET_TTL' in os.environ) else 900
+
+# Idle connections kept open for reuse by this process
+POOL_SIZE = int(os.environ['ANN_DB_POOL_SIZE']) if \
+    ('ANN_DB_POOL_SIZE' in os.environ) else 4
+
+_secret = None
+_secret_time = 0
+_pool = []
+_pool_pid = os.getpid()
+_pool_lock = threading.Lock()
+_backend = None
+
+
+"""Get RDS credentials from AWS Secrets Manager, cached for SECRET_TTL
 """
-def db_connect():
+def get_rds_secret():
+    global _secret, _secret_time
+
+    if (_secret is not None) and (time.time() - _secret_time < SECRET_TTL):
+        return _secret
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-    # Get RDS secret from AWS Secrets Manager
     asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
         asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
@@ -32,20 +67,187 @@ def db_connect():
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    _secret = rds_secret
+    _secret_time = time.time()
+    return _secret
+
+
+"""Connection handed out by db_connect(); close() gives it back to the pool
+"""
+class PooledConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        if (self._conn is not None):
+            release(self._conn)
+        self._conn = None
+
+    """Closes the connection instead of pooling it, e.g. when an
+       unbuffered result has not been read to the end
+    """
+    def discard(self):
+        if (self._conn is not None):
+            self._conn.close()
+        self._conn = None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+"""Returns a connection to the pool, or closes it if the pool is full
+"""
+def release(conn):
+    try:
+        # End the implicit transaction so the next user sees fresh data
+        conn.rollback()
+    except pymysql.MySQLError:
+        # Broken; close it rather than leave its socket to the collector
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+
+    with _pool_lock:
+        if (os.getpid() == _pool_pid) and (len(_pool) < POOL_SIZE):
+            _pool.append(conn)
+            return
+    conn.close()
+
+
+"""Closes all idle connections
+"""
+def close_pool():
+    with _pool_lock:
+        while (len(_pool) > 0):
+            _pool.pop().close()
+
+
+def _checkout():
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if (os.getpid() != _pool_pid):
+            # Connections inherited from the parent process must not be shared
+            _pool = []
+            _pool_pid = os.getpid()
+        while (len(_pool) > 0):
+            conn = _pool.pop()
+            try:
+                conn.ping(reconnect=True)
+                return conn
+            except pymysql.MySQLError:
+                pass
+    return None
+
+
+"""RDS reference database; idle connections are reused and the caller's
+   close() returns a connection to the pool
+"""
+class MySqlBackend(object):
+    def connect(self):
+        conn = _checkout()
+        if (conn is not None):
+            return PooledConnection(conn)
+
+        rds_secret = get_rds_secret()
+
+        # Extract database connection parameters
+        rds_host = rds_secret['host']
+        mysql_port = rds_secret['port']
+        username = rds_secret['username']
+        password = rds_secret['password']
+        database_name = 'annotator'
+
+        # Return a connection to the database
+        return PooledConnection(pymysql.connect(
+            host=rds_host,
+            port=mysql_port,
+            user=username,
+            passwd=password,
+            db=database_name))
+
+    """Unbuffered cursor: rows are streamed from the server as they are
+       read; only one such result can be open on a connection at a time
+    """
+    def stream_cursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+
+"""Connection to the local replica, with the methods the annotators use
+   on a pymysql connection
+"""
+class SqliteConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursorclass=None):
+        return self._conn.cursor()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        self._conn.close()
+
+    def discard(self):
+        self._conn.close()
+
+
+"""Local read-only replica of the reference database in a SQLite file
+"""
+class SqliteBackend(object):
+    def __init__(self, path=DB_SQLITE_PATH):
+        if not os.path.isfile(path):
+            raise IOError(f"Reference database replica '{path}' not found")
+        self.path = os.path.abspath(path)
+
+    def connect(self):
+        conn = sqlite3.connect('file:' + self.path + '?mode=ro', uri=True)
+        conn.execute('pragma mmap_size = 1073741824;')
+        return SqliteConnection(conn)
+
+    """SQLite cursors already step through a result as it is read
+    """
+    def stream_cursor(self, conn):
+        return conn.cursor()
+
+
+_backends = {'mysql': MySqlBackend, 'sqlite': SqliteBackend}
+
+
+"""Backend named by DB_BACKEND, created on first use
+"""
+def get_backend():
+    global _backend
+    if (_backend is None):
+        if (DB_BACKEND not in _backends):
+            raise ValueError(f"Unknown reference database backend '{DB_BACKEND}'")
+        _backend = _backends[DB_BACKEND]()
+    return _backend
+
+
+"""Replaces the backend of this process, e.g. with SqliteBackend(path)
+"""
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+"""Get connection to reference database
+"""
+def db_connect():
+    return get_backend().connect()
+
+
+"""Cursor streaming its result rather than fetching it whole
+"""
+def stream_cursor(conn):
+    return get_backend().stream_cursor(conn)
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,144 @@
+# vcf_record.py
+#
+# Data line of a VCF as passed through the annotation stages. CHROM, POS,
+# REF and ALT are parsed once; INFO is held as a list of fragments that
+# the stages append to and that is joined only when the whole field is
+# needed, typically when the record is written
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+# Columns of CHROM, POS, REF, ALT in a VCF (see utils.getFormatSpecificIndices)
+VCF_INDICES = [0, 1, 3, 4]
+
+INFO = 7
+
+
+"""Indexing gives the columns as strings, as on the split line; INFO
+   (column 7) is kept in self.info, self.fields[7] is not used
+"""
+class VcfRecord(object):
+    __slots__ = ['fields', 'info', 'inds', 'chrom', 'pos', 'ref', 'alt']
+
+    def __init__(self, fields, inds=VCF_INDICES):
+        self.inds = inds
+        self.setFields(fields)
+
+    @classmethod
+    def parse(cls, line, sep='\t', inds=VCF_INDICES):
+        return cls(line.split(sep), inds)
+
+    def setFields(self, fields):
+        self.fields = fields
+        self.info = None
+        if (len(fields) > INFO):
+            self.info = [fields[INFO]]
+            fields[INFO] = None
+        inds = self.inds
+        self.chrom = fields[inds[0]].strip()
+        self.pos = fields[inds[1]].strip()
+        self.ref = fields[inds[2]].strip() if (len(fields) > inds[2]) else ''
+        self.alt = fields[inds[3]].strip() if (len(fields) > inds[3]) else ''
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, i):
+        if (i == INFO) or ((i < 0) and (len(self.fields) + i == INFO)):
+            return self.getInfo()
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        if (i == INFO) or ((i < 0) and (len(self.fields) + i == INFO)):
+            self.setInfo(value)
+        else:
+            self.fields[i] = value
+
+    """INFO as one string
+    """
+    def getInfo(self):
+        info = self.info
+        if (info is None):
+            raise IndexError('record has no INFO column')
+        if (len(info) > 1):
+            info[:] = [''.join(info)]
+        return info[0]
+
+    def setInfo(self, text):
+        if (self.info is None):
+            raise IndexError('record has no INFO column')
+        self.info[:] = [text]
+
+    """Appends text to INFO as it is, separators included
+    """
+    def addInfo(self, text):
+        if (self.info is None):
+            raise IndexError('record has no INFO column')
+        self.info.append(text)
+
+    """Appends an entry to INFO, after a ';' unless INFO ends with one
+    """
+    def addInfoEntry(self, text):
+        if not self.infoEndsWith(';'):
+            self.info.append(';')
+        self.info.append(text)
+
+    def infoEndsWith(self, suffix):
+        last = self.info[-1]
+        if (len(last) >= len(suffix)):
+            return last.endswith(suffix)
+        return self.getInfo().endswith(suffix)
+
+    """All columns, INFO joined
+    """
+    def columns(self):
+        fields = list(self.fields)
+        if (self.info is not None):
+            fields[INFO] = self.getInfo()
+        return fields
+
+    def line(self, sep='\t'):
+        if (self.info is not None):
+            self.fields[INFO] = self.getInfo()
+            text = sep.join(self.fields)
+            self.fields[INFO] = None
+            return text
+        return sep.join(self.fields)
+
+    def copy(self):
+        record = VcfRecord.__new__(VcfRecord)
+        record.fields = list(self.fields)
+        record.info = list(self.info) if (self.info is not None) else None
+        record.inds = self.inds
+        record.chrom = self.chrom
+        record.pos = self.pos
+        record.ref = self.ref
+        record.alt = self.alt
+        return record
+
+    """Prefixes every column but CHROM with a space, as the gadAll stage
+       has always written its annotated lines
+    """
+    def pad(self):
+        fields = self.fields
+        for i in range(1, len(fields)):
+            if (i == INFO):
+                self.info.insert(0, ' ')
+            else:
+                fields[i] = ' ' + fields[i]
+
+    """Each stage used to re-read the previous stage's output with
+       line.strip(); keep records identical to what that re-read would give
+    """
+    def restrip(self, sep='\t'):
+        first = self.fields[0]
+        last = self.fields[-1]
+        if (len(self.fields) - 1 == INFO):
+            last = self.info[-1]
+            if (last == ''):
+                last = self.getInfo()
+        if ((first == '') or first[0].isspace() or
+            (last == '') or last[-1].isspace()):
+            self.setFields(self.line(sep).strip().split(sep))
+
+### EOF
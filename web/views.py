@@ -115,7 +115,9 @@ def create_annotation_job_request():
           "s3_key_input_file": s3_key,
           "st":st,
           "submit_time": submit_time,
-          "job_status": "PENDING"}
+          "job_status": "PENDING",
+          # Premium jobs are scheduled ahead of free ones by the annotator
+          "priority": "premium" if (session.get('role') == "premium_user") else "free"}
   
   '''
   References: